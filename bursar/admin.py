@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 
 from django.utils.translation import ugettext as _
+from django import http, shortcuts
+from django.conf.urls import patterns, url
 from django.contrib import admin
-from bursar import models
+from django.forms.models import BaseInlineFormSet
+from bursar import models, jobs
+
+class CreditCardDetailFormSet(BaseInlineFormSet):
+    def get_queryset(self):
+        """ decrypt all shown cards at once """
+        queryset = super(CreditCardDetailFormSet, self).get_queryset()
+        models.CreditCardDetail.objects.decrypt_many(queryset)
+        return queryset
 
 class CreditCardDetail_Inline(admin.TabularInline):
     model = models.CreditCardDetail
+    formset = CreditCardDetailFormSet
     readonly_fields = ['name', 'card_type', 'card_no', 'expirationDate', 'ccv', 'start_date', 'issue_num']
     extra = 0
 
@@ -14,24 +25,52 @@ class PaymentNote_Inline(admin.TabularInline):
     readonly_fields = ['note']
     extra = 0
 
+def _capture_authorized(queryset):
+    return len([1 for p in models.Payment.objects.capture_authorized_many(queryset) if p.status == 'CD'])
+
+def _cancel(queryset):
+    cancelled = models.Payment.objects.release_authorized_many(queryset) + models.Payment.objects.refund_many(queryset)
+    return len([1 for p in cancelled if not p.success])
+
+def _update_status(queryset):
+    return len(models.Payment.objects.update_status_many(queryset))
+
 class PaymentAdmin(admin.ModelAdmin):
     list_filter = ['method', 'status']
     list_display = ['id', 'purchase', 'method', 'amount', 'status_name', 'reason', 'transaction_id', 'time_stamp']
+    list_select_related = True
     fields = ['purchase', 'method', 'amount', 'status', 'reason', 'details', 'transaction_id']
     readonly_fields = ['purchase', 'method', 'status', 'reason', 'transaction_id']
     inlines = [CreditCardDetail_Inline, PaymentNote_Inline]
     actions = ['capture_authorized', 'cancel', 'update_status']
 
+    def get_urls(self):
+        return patterns('',
+                url(r'^jobs/(?P<job_id>\w+)/$', self.admin_site.admin_view(self.job_progress), name='bursar_payment_job'),
+            ) + super(PaymentAdmin, self).get_urls()
+
+    def _start_job(self, name, operation, queryset):
+        """ actions run in background in batches, see jobs.py """
+        job_id = jobs.start(name, operation, queryset.values_list('id', flat=True))
+        return shortcuts.redirect('admin:bursar_payment_job', job_id)
+
+    def job_progress(self, request, job_id):
+        state = jobs.progress(job_id)
+        if state is None:
+            raise http.Http404
+        return shortcuts.render(request, 'bursar/job_progress.html', {
+                'title' : state['name'],
+                'job'   : state,
+                'opts'  : self.model._meta,
+            })
+
     def capture_authorized(self, request, queryset):
-        count = len([1 for p in queryset if p.status == 'A' and not p.capture_authorized().status=='CD'])
-        self.message_user(request, _("%s payment(s) captured.")%count)
+        return self._start_job(_("Capture authorized payments"), _capture_authorized, queryset)
 
     def cancel(self, request, queryset):
-        count = len([1 for p in queryset if p.success and not p.cancel().success])
-        self.message_user(request, _("%s payment(s) cancelled.")%count)
+        return self._start_job(_("Cancel payments"), _cancel, queryset)
 
     def update_status(self, request, queryset):
-        count = len([1 for p in queryset if p.update_status()])
-        self.message_user(request, _("%s payment(s) updated.")%count)
+        return self._start_job(_("Update payment status"), _update_status, queryset)
 
 admin.site.register(models.Payment, PaymentAdmin)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for bursar hot paths. Run with django settings configured, eg:
+    DJANGO_SETTINGS_MODULE=myproject.settings python -m bursar.benchmarks [--json] [--save FILE] [--baseline FILE]
+Results are microseconds per call. With --baseline, benchmarks slower than the
+stored results by more than --tolerance fail the run (exit status 1), so keep
+the baseline produced on the same machine, eg by CI with --save.
+Purchase lifecycle is run on a temporary SQLite test database and needs
+MAKE_TEST_PURCHASE setting; gateway benchmarks run for active gateways only.
+Import times are measured in fresh interpreters and need DJANGO_SETTINGS_MODULE.
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import datetime
+import timeit
+import optparse
+
+from django import forms as django_forms
+from django.forms.util import ErrorDict
+
+from bursar import utils, fields, forms, models, bins
+from bursar import settings as bursar_settings
+
+CARD_NUMBERS = (
+    '4444333322221111',     # VISA
+    '4917300800000000',     # VISA ELECTRON
+    '5555555555554444',     # MASTERCARD
+    '343434343434343',      # AMEX
+    '36700102000000',       # DC
+    '6304900017740292441',  # MAESTRO
+    '6225880120625588',     # UNIONPAY
+    '1234567890123456',     # unknown
+)
+
+FORM_DATA = {
+    'name'   : 'John Smith',
+    'card_no': '4444333322221111',
+    'expiry' : datetime.date.today() + datetime.timedelta(days=400),
+    'cvc'    : '123',
+}
+
+PAYMENT_NODE = '''<payment>
+    <paymentMethod>VISA-SSL</paymentMethod>
+    <amount value="1050" currencyCode="GBP" exponent="2" debitCreditIndicator="credit"/>
+    <lastEvent>AUTHORISED</lastEvent>
+    <ISO8583ReturnCode code="0" description="APPROVED"/>
+    <balance accountType="IN_PROCESS_AUTHORISED">
+        <amount value="1050" currencyCode="GBP" exponent="2" debitCreditIndicator="credit"/>
+    </balance>
+</payment>'''
+
+# run in a fresh interpreter with gateway apps (JSON list) to declare, or null to scan
+# INSTALLED_APPS, prints {phase: seconds}
+IMPORT_SCRIPT = '''
+import sys, json, time
+from django.conf import settings
+bursar_config = dict(getattr(settings, 'BURSAR_SETTINGS', {}), GATEWAYS=json.loads(sys.argv[1]), GATEWAY_MANIFEST=None)
+if bursar_config['GATEWAYS'] is None:
+    del bursar_config['GATEWAYS']
+settings.BURSAR_SETTINGS = bursar_config
+timings = {}
+started = time.time()
+from bursar import settings as bursar_settings
+timings['import bursar.settings'] = time.time() - started
+started = time.time()
+import bursar.models, bursar.urls
+timings['import bursar.models and urls'] = time.time() - started
+if bursar_settings._resolved:
+    raise SystemExit('importing bursar.models or bursar.urls resolved bursar settings')
+started = time.time()
+bursar_settings.ACTIVE_GATEWAYS
+timings['bursar settings resolution'] = time.time() - started
+print json.dumps(timings)
+'''
+
+def _get_cardtype_re(card_no):
+    """ sequential regexp scan, as get_cardtype used to be implemented """
+    for type, (lens, pattern) in utils.card_types:
+        if len(card_no) in lens and re.match(pattern, card_no):
+            return type
+
+def timeit_per_call(func, args, number=10000, repeat=3):
+    """ best of `repeat` runs, microseconds per func(arg) call """
+    number = max(int(number), 1)
+    seconds = min(timeit.repeat(lambda: [func(arg) for arg in args], number=number, repeat=repeat))
+    return seconds / number / len(args) * 1e6
+
+def bench_get_cardtype(number=10000):
+    return {
+        'get_cardtype'              : timeit_per_call(utils.get_cardtype, CARD_NUMBERS, number),
+        'get_cardtype (regexp scan)': timeit_per_call(_get_cardtype_re, CARD_NUMBERS, number),
+    }
+
+def bench_is_mod10(number=10000):
+    return {
+        'is_mod10'                  : timeit_per_call(utils.is_mod10, CARD_NUMBERS, number),
+    }
+
+def bench_forms(number=2000):
+    card_field = fields.CreditCardField()
+    def validate(card_no):
+        try:
+            card_field.validate(card_no)
+        except django_forms.ValidationError:
+            pass
+
+    form = forms.BaseCreditCardForm()
+    def clean(card_no):
+        form._errors = ErrorDict()
+        form.cleaned_data = dict(FORM_DATA, card_no=card_no)
+        try:
+            form.clean()
+        except django_forms.ValidationError:
+            pass
+
+    return {
+        'CreditCardField.validate'  : timeit_per_call(validate, CARD_NUMBERS, number),
+        'BaseCreditCardForm.clean'  : timeit_per_call(clean, CARD_NUMBERS, number),
+    }
+
+def bench_crypto(number=2000):
+    codes = [models._encrypt_code(unicode(card_no)) for card_no in CARD_NUMBERS]
+    return {
+        'encrypt card number'       : timeit_per_call(models._encrypt_code, [unicode(c) for c in CARD_NUMBERS], number),
+        'decrypt card number'       : timeit_per_call(models._decrypt_code, codes, number),
+        'decrypt_many (per card)'   : timeit_per_call(models.decrypt_many, [codes], number) / len(codes),
+    }
+
+def bench_bins(number=10000, ranges=100000):
+    """ lookups in a memory mapped database of `ranges` 8 digit BIN ranges """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bins')
+        csv_lines = ['start,end,issuer,country,funding,card_type']
+        csv_lines.extend('%d,%d,Bank %d,GB,debit,VISA' % (bin, bin, i)
+                         for i, bin in enumerate(range(40000000, 50000000, 10000000 // ranges)))
+        bins.compile_csv(csv_lines, path)
+        database = bins.BinDatabase(path)
+        return {
+            'BIN database lookup'   : timeit_per_call(database.lookup, CARD_NUMBERS, number),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+def bench_worldpay(number=500):
+    if 'worldpay' not in dict(bursar_settings.ACTIVE_GATEWAYS):
+        return {}
+    from lxml import etree
+    from bursar.gateway.worldpay import builder, processor
+    from bursar.gateway.worldpay.fixtures import test_payment, default_form_data, default_request
+
+    gateway = utils.get_processor_instance('worldpay')
+    requests = (
+        ('worldpay/authorize.xml', {
+            'form_data'     : default_form_data,
+            'request'       : default_request,
+            'payment_method': processor.PAYMENT_METHOD_CODES['VISA'],
+        }),
+        ('worldpay/capture_authorized.xml', {'amount': 5.25}),
+        ('worldpay/get_status.xml', {}),
+    )
+    def build(request):
+        template, variables = request
+        return gateway.build_request(template, test_payment(), variables)
+
+    results = {}
+    saved_builders = gateway.builders
+    try:
+        for mode, builders in (('template', {}), ('lxml', builder.BUILDERS)):
+            gateway.builders = builders
+            results['worldpay build_request (%s)' % mode] = timeit_per_call(build, requests, number)
+    finally:
+        gateway.builders = saved_builders
+
+    payment_node = etree.fromstring(PAYMENT_NODE)
+    results['worldpay parse_payment_node'] = timeit_per_call(gateway.parse_payment_node, [payment_node], number * 10)
+    return results
+
+def bench_auto_capture(number=50):
+    """ full autosuccess purchase lifecycle: authorization, capture and database writes """
+    if 'autosuccess' not in dict(bursar_settings.ACTIVE_GATEWAYS) or \
+       not bursar_settings.working_settings.get('MAKE_TEST_PURCHASE'):
+        return {}
+    from bursar.tests import make_test_purchase
+    def lifecycle(form_data):
+        make_test_purchase(10).auto_capture('autosuccess', form_data)
+    return {
+        'auto_capture lifecycle'    : timeit_per_call(lifecycle, [FORM_DATA], number),
+    }
+
+def bench_import(number=5):
+    """ cold import and settings resolution, with gateways declared and found by INSTALLED_APPS scan """
+    if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        return {}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    declared = json.dumps([app for name, app in bursar_settings.ACTIVE_GATEWAYS])
+    results = {}
+    for mode, gateways in (('declared', declared), ('scan', 'null')):
+        for i in range(max(int(number), 1)):
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT, gateways], env=env)
+            for name, seconds in json.loads(output.splitlines()[-1]).items():
+                name = '%s (%s)' % (name, mode)
+                results[name] = min(results.get(name, seconds * 1e6), seconds * 1e6)
+    return results
+
+BENCHMARKS = (
+    bench_get_cardtype,
+    bench_is_mod10,
+    bench_forms,
+    bench_crypto,
+    bench_bins,
+    bench_worldpay,
+    bench_auto_capture,
+    bench_import,
+)
+
+def run(benchmarks=BENCHMARKS, scale=1.0):
+    """ {benchmark name: microseconds per call}. scale < 1 makes runs shorter and less precise """
+    results = {}
+    for bench in benchmarks:
+        default_number = bench.func_defaults[0]
+        results.update(bench(number=default_number * scale))
+    return results
+
+def compare(results, baseline, tolerance=0.25):
+    """ [(name, baseline usec, usec), ..] of benchmarks slower than baseline by more than tolerance """
+    return [(name, baseline[name], usec) for name, usec in sorted(results.items())
+            if name in baseline and usec > baseline[name] * (1 + tolerance)]
+
+def setup_database():
+    """ temporary SQLite database for lifecycle benchmark """
+    from django.db import connection
+    if connection.vendor != 'sqlite':
+        return False
+    connection.creation.create_test_db(verbosity=0)
+    return True
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--json', action='store_true', default=False, help='print results as JSON')
+    parser.add_option('--save', metavar='FILE', help='store results as baseline')
+    parser.add_option('--baseline', metavar='FILE', help='fail if results are slower than stored in FILE')
+    parser.add_option('--tolerance', type='float', default=0.25, help='allowed slowdown against baseline [%default]')
+    parser.add_option('--scale', type='float', default=1.0, help='multiplier of number of calls [%default]')
+    options, args = parser.parse_args(argv)
+
+    benchmarks = BENCHMARKS
+    if not setup_database():
+        benchmarks = [bench for bench in BENCHMARKS if bench is not bench_auto_capture]
+    results = run(benchmarks, options.scale)
+
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        for name, usec in sorted(results.items()):
+            print '%-40s %10.3f usec' % (name, usec)
+
+    if options.save:
+        with open(options.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), options.tolerance)
+        for name, baseline_usec, usec in regressions:
+            sys.stderr.write('REGRESSION %s: %.3f usec, baseline %.3f usec (+%d%%)\n'
+                             % (name, usec, baseline_usec, (usec / baseline_usec - 1) * 100))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
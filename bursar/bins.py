@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+BIN (IIN) range database: issuer, country, funding and card type by card
+number prefix, with no database queries. Ranges are compiled from CSV
+
+    start,end,issuer,country,funding,card_type
+    457173,457173,Danske Bank,DK,debit,VISA
+    51,55,,,credit,MASTERCARD
+
+into a file of sorted fixed width records, which is memory mapped (read-only
+pages are shared by all worker processes) and searched by bisection:
+
+    python manage.py compile_bins ranges.csv    # writes BIN_DATABASE file
+
+    bins.lookup('4571730000000000')
+    => {'issuer': 'Danske Bank', 'country': 'DK', 'funding': 'debit', 'card_type': 'VISA'}
+
+Ranges may be nested, the narrowest one wins. A regenerated file is picked up
+within BIN_DATABASE_CHECK seconds, no restart needed.
+"""
+import os
+import csv
+import json
+import mmap
+import time
+import struct
+import threading
+
+from bursar import settings as bursar_settings
+
+MAGIC = 'BURSARBN'
+VERSION = 1
+HEADER = struct.Struct('>8sHII')  # magic, version, number of records, offset of info table
+RECORD = struct.Struct('>QQI')    # first key, last key, info table index
+KEY = struct.Struct('>Q')
+KEY_DIGITS = 12                   # card number prefix digits ranges are matched on
+INFO_FIELDS = ('issuer', 'country', 'funding', 'card_type')
+
+def prefix_range(start, end=''):
+    """ ('4571', '4572') => (457100000000, 457299999999) """
+    start, end = start.strip(), (end or start).strip()
+    if not (start.isdigit() and end.isdigit()) or max(len(start), len(end)) > KEY_DIGITS:
+        raise ValueError('Invalid BIN range %s-%s' % (start, end))
+    low, high = int(start.ljust(KEY_DIGITS, '0')), int(end.ljust(KEY_DIGITS, '9'))
+    if low > high:
+        raise ValueError('Invalid BIN range %s-%s' % (start, end))
+    return low, high
+
+def card_key(card_no):
+    return int(card_no[:KEY_DIGITS].ljust(KEY_DIGITS, '0'))
+
+def flatten(ranges):
+    """ [(low, high, info), ..], possibly nested => sorted disjoint [(low, high, info), ..].
+        Inside a range, the narrower ranges it contains win """
+    segments = []
+    def emit(low, high, info):
+        if low > high:
+            return
+        if segments and segments[-1][1] == low - 1 and segments[-1][2] == info:
+            segments[-1] = (segments[-1][0], high, info)
+        else:
+            segments.append((low, high, info))
+
+    stack, position = [], 0 # open ranges, innermost last; first key not emitted yet
+    for low, high, info in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][1] < low:
+            closed = stack.pop()
+            emit(position, closed[1], closed[2])
+            position = max(position, closed[1] + 1)
+        if stack:
+            emit(position, low - 1, stack[-1][2])
+        stack.append((low, high, info))
+        position = max(position, low)
+    while stack:
+        closed = stack.pop()
+        emit(position, closed[1], closed[2])
+        position = max(position, closed[1] + 1)
+    return segments
+
+def compile_csv(csv_file, path):
+    """ Compiles CSV file object (see module docstring) into database at path.
+        Written to a temporary file and renamed, so readers see either the old
+        or the new database. Returns number of records """
+    infos, ranges = {}, []
+    for line, row in enumerate(csv.DictReader(csv_file), 2):
+        try:
+            low, high = prefix_range(row['start'], row.get('end'))
+        except (KeyError, AttributeError, ValueError), e:
+            raise ValueError('line %s: %s' % (line, e))
+        info = tuple((row.get(field) or '').strip() or None for field in INFO_FIELDS)
+        ranges.append((low, high, infos.setdefault(info, len(infos))))
+
+    segments = flatten(ranges)
+    table = [None] * len(infos)
+    for info, index in infos.items():
+        table[index] = info
+
+    with open(path + '.tmp', 'wb') as database:
+        database.write(HEADER.pack(MAGIC, VERSION, len(segments), HEADER.size + RECORD.size * len(segments)))
+        for segment in segments:
+            database.write(RECORD.pack(*segment))
+        database.write(json.dumps(table))
+    os.rename(path + '.tmp', path)
+    return len(segments)
+
+class BinDatabase(object):
+    """ Memory mapped database compiled by compile_csv(). The file is checked for
+        changes at most every `check_interval` seconds and remapped if replaced """
+    def __init__(self, path, check_interval=10):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._next_check = 0
+        self._signature = None
+        self._state = None # (mmap, number of records, info table), swapped at once
+        self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as database:
+            signature = os.fstat(database.fileno())
+            data = mmap.mmap(database.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, table_offset = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a BIN database' % self.path)
+        table = [dict(zip(INFO_FIELDS, info)) for info in json.loads(data[table_offset:])]
+        self._state = (data, count, table)
+        self._signature = (signature.st_ino, signature.st_mtime, signature.st_size)
+        self._next_check = time.time() + self.check_interval
+
+    def _check(self):
+        if time.time() < self._next_check:
+            return
+        with self._lock:
+            if time.time() < self._next_check:
+                return
+            self._next_check = time.time() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return # keep serving the mapped data
+            if (stat.st_ino, stat.st_mtime, stat.st_size) != self._signature:
+                self._load()
+
+    def __len__(self):
+        return self._state[1]
+
+    def lookup(self, card_no):
+        """ {'issuer':.., 'country':.., 'funding':.., 'card_type':..} of range card_no
+            belongs to (missing values are None), None if there is no such range """
+        self._check()
+        data, count, table = self._state
+        key = card_key(card_no)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(data, HEADER.size + middle * RECORD.size)[0] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low:
+            first, last, info = RECORD.unpack_from(data, HEADER.size + (low - 1) * RECORD.size)
+            if key <= last:
+                return dict(table[info])
+        return None
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(path=None):
+    """ process wide BinDatabase of path, BIN_DATABASE setting by default.
+        None if no database is configured """
+    path = path or bursar_settings.working_settings.get('BIN_DATABASE')
+    if not path:
+        return None
+    database = _databases.get(path)
+    if database is None:
+        with _databases_lock:
+            database = _databases.get(path)
+            if database is None:
+                database = _databases[path] = BinDatabase(path,
+                        bursar_settings.working_settings.get('BIN_DATABASE_CHECK', 10))
+    return database
+
+def lookup(card_no):
+    """ BinDatabase.lookup in configured database, None if there is none """
+    database = get_database()
+    return database and database.lookup(card_no)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Client side card detection. utils.card_types and gateway CREDITCHOICES are
+compiled into a static script, so card number fields find the card type
+(prefix, length and Luhn checks) in the browser instead of calling the
+cardtype view on every keystroke:
+
+    python manage.py build_card_bundle   # then collectstatic, if used
+
+writes bursar/js/cards.<version>.js and cards.json (same data, for other
+clients). Version is a hash of the data, so the files can be served with far
+future expiry. fields.CardNumberInput includes the script of the current
+version; rebuild the bundle whenever card types or CREDITCHOICES change.
+"""
+import os
+import json
+import hashlib
+
+from django.utils import importlib
+
+from bursar import utils
+from bursar import settings as bursar_settings
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'static', 'bursar', 'js')
+
+SCRIPT = '''/* Generated by build_card_bundle from bursar.utils.card_types, do not edit */
+(function (root) {
+    var data = %(data)s;
+
+    function digits(value) {
+        return String(value || '').replace(/\\D/g, '');
+    }
+
+    function luhn(number) {
+        var total = 0;
+        for (var i = 0; i < number.length; i++) {
+            var digit = +number.charAt(number.length - 1 - i);
+            total += i %% 2 === 0 ? digit : (digit <= 4 ? 2 * digit : 2 * digit - 9);
+        }
+        return total %% 10 === 0;
+    }
+
+    function find(number, complete) {
+        for (var i = 0; i < data.types.length; i++) {
+            var type = data.types[i], lengths = type[1], prefixes = type[2];
+            var longest = Math.max.apply(null, lengths);
+            if (complete ? lengths.indexOf(number.length) < 0 : number.length > longest) {
+                continue;
+            }
+            for (var j = 0; j < prefixes.length; j++) {
+                if (number.lastIndexOf(prefixes[j], 0) === 0) {
+                    return type[0];
+                }
+            }
+        }
+        return null;
+    }
+
+    var cards = root.bursarCards = {
+        version: data.version,
+        names: data.names,
+        gateways: data.gateways,
+        /* card type of a partially typed number, to highlight its logo */
+        guess: function (value) {
+            return find(digits(value), false);
+        },
+        /* card type of a complete number passing Luhn check, as utils.get_cardtype
+           and utils.is_mod10 do; null if it is invalid or not in accept list */
+        detect: function (value, accept) {
+            var number = digits(value), type = number && luhn(number) ? find(number, true) : null;
+            return type && (!accept || accept.indexOf(type) >= 0) ? type : null;
+        },
+        luhn: function (value) {
+            return luhn(digits(value));
+        },
+        /* marks logo of the typed card next to input: .card element with its data-card-type */
+        bind: function (input) {
+            var accept = input.getAttribute('data-accept') ? input.getAttribute('data-accept').split(',') : null;
+            var logos = input.parentNode.querySelectorAll('.card');
+            function update() {
+                var type = cards.detect(input.value, accept) || cards.guess(input.value);
+                input.setAttribute('data-card-type', type || '');
+                for (var i = 0; i < logos.length; i++) {
+                    var selected = type !== null && logos[i].getAttribute('data-card-type') === type;
+                    logos[i].className = logos[i].className.replace(/\\s*card-selected/g, '') + (selected ? ' card-selected' : '');
+                }
+            }
+            input.addEventListener('input', update, false);
+            update();
+        }
+    };
+
+    function bindAll() {
+        var inputs = document.querySelectorAll('input[data-bursar-card]');
+        for (var i = 0; i < inputs.length; i++) {
+            cards.bind(inputs[i]);
+        }
+    }
+    if (root.document) {
+        if (document.readyState === 'loading') {
+            document.addEventListener('DOMContentLoaded', bindAll, false);
+        } else {
+            bindAll();
+        }
+    }
+})(this);
+'''
+
+def build():
+    """ bundle data: card types as [type, lengths, literal prefixes] in card_types
+        order (first match wins, as in get_cardtype), card names and accepted
+        card types of active gateways, and version hash of all of it """
+    types = []
+    for card_type, (lengths, pattern) in utils.card_types:
+        types.append([card_type, list(lengths), utils._expand_pattern(pattern)[0]])
+
+    names, gateways = {}, {}
+    for name, app in bursar_settings.ACTIVE_GATEWAYS:
+        choices = bursar_settings.gateway(importlib.import_module(app).PROCESSOR_KEY).get('CREDITCHOICES', ())
+        gateways[name] = [card_type for card_type, card_name in choices]
+        for card_type, card_name in choices:
+            names.setdefault(card_type, unicode(card_name))
+
+    data = {'types': types, 'names': names, 'gateways': gateways}
+    data['version'] = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()[:10]
+    return data
+
+_version = None
+
+def version():
+    """ version of bundle for current card types and settings """
+    global _version
+    if _version is None:
+        _version = build()['version']
+    return _version
+
+def script_name(bundle_version=None):
+    """ static path of the script """
+    return 'bursar/js/cards.%s.js' % (bundle_version or version())
+
+def write(output=DEFAULT_OUTPUT):
+    """ writes cards.<version>.js and cards.json to output directory. Returns paths written """
+    data = build()
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    paths = (os.path.join(output, os.path.basename(script_name(data['version']))),
+             os.path.join(output, 'cards.json'))
+    contents = (SCRIPT % {'data': json.dumps(data, sort_keys=True)}, json.dumps(data, sort_keys=True, indent=2))
+    for path, content in zip(paths, contents):
+        with open(path + '.tmp', 'w') as bundle:
+            bundle.write(content)
+        os.rename(path + '.tmp', path)
+    return paths
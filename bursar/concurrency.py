@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking counterparts of gateway, payment and purchase operations.
+Calls are run on a process wide thread pool and return concurrent.futures.Future,
+which async frameworks can wait on (eg tornado gen.coroutine, twisted
+deferToThread-like wrappers, or asyncio.wrap_future on python 3).
+Requires concurrent.futures (`futures` package on python 2).
+"""
+import os
+import threading
+
+from django.db import connections
+from django.core.exceptions import ImproperlyConfigured
+
+from bursar import settings as bursar_settings
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """ process wide executor, (re)created on first use after fork """
+    global _executor, _executor_pid
+    if futures is None:
+        raise ImproperlyConfigured('Please install "futures" package to use asynchronous bursar API')
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = futures.ThreadPoolExecutor(bursar_settings.EXECUTOR_WORKERS)
+                _executor_pid = os.getpid()
+    return _executor
+
+def submit(func, *args, **kwargs):
+    """ run func in executor, returns Future """
+    return get_executor().submit(func, *args, **kwargs)
+
+def closing_connections(func):
+    """ func closing database connections of its thread when done. Executor
+        threads outlive requests, nothing else would close them """
+    def call(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for connection in connections.all():
+                connection.close()
+    return call
+
+def completed(func, *args, **kwargs):
+    """ call func right away, returns resolved Future. For operations that don't wait on network """
+    if futures is None:
+        raise ImproperlyConfigured('Please install "futures" package to use asynchronous bursar API')
+    future = futures.Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception, e:
+        future.set_exception(e)
+    return future
+
+def async_method(name):
+    """ makes a-prefixed counterpart of method `name`, eg:
+        aauthorize = async_method('authorize')
+        The method runs on its own database connection, closed when it is done,
+        so it sees committed data only: commit the instance (and what it
+        refers to) before the call, eg outside of TransactionMiddleware """
+    def method(self, *args, **kwargs):
+        return submit(closing_connections(getattr(self, name)), *args, **kwargs)
+    method.__name__ = 'a' + name
+    method.__doc__ = """ Non-blocking .%s(), returns concurrent.futures.Future.
+        Runs on its own database connection: commit the instance first """ % name
+    return method
+
+_fanout_executor = None
+_fanout_executor_pid = None
+
+def get_fanout_executor():
+    """ process wide executor for fan_out. Separate from get_executor(), so
+        asynchronous purchase operations can fan out without waiting on their own pool """
+    global _fanout_executor, _fanout_executor_pid
+    if _fanout_executor is None or _fanout_executor_pid != os.getpid():
+        with _executor_lock:
+            if _fanout_executor is None or _fanout_executor_pid != os.getpid():
+                _fanout_executor = futures.ThreadPoolExecutor(bursar_settings.FANOUT_WORKERS)
+                _fanout_executor_pid = os.getpid()
+    return _fanout_executor
+
+def fan_out(calls, limit, executor=None):
+    """ Runs independent calls [(func, args), ..], at most `limit` at once,
+        on `executor` (get_fanout_executor() by default).
+        Waits for all of them and returns [(result, exception), ..] in calls order,
+        so caller can record successful calls even if some failed.
+        Runs calls one by one if limit is 1 or "futures" is not installed;
+        otherwise each call runs on its own database connection, closed when done """
+    calls = list(calls)
+    outcomes = [None] * len(calls)
+    if futures is None or limit <= 1 or len(calls) <= 1:
+        for index, (func, args) in enumerate(calls):
+            try:
+                outcomes[index] = (func(*args), None)
+            except Exception, e:
+                outcomes[index] = (None, e)
+        return outcomes
+
+    executor = executor or get_fanout_executor()
+    queued = iter(enumerate(calls))
+    running = {}
+    def submit_next():
+        for index, (func, args) in queued:
+            running[executor.submit(closing_connections(func), *args)] = index
+            return
+
+    for _ in range(limit):
+        submit_next()
+    while running:
+        done = futures.wait(running, return_when=futures.FIRST_COMPLETED)[0]
+        for future in done:
+            index = running.pop(future)
+            error = future.exception()
+            outcomes[index] = (None, error) if error is not None else (future.result(), None)
+            submit_next()
+    return outcomes
@@ -2,8 +2,10 @@
 import re, datetime
 
 from django import forms
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
-from bursar import utils
+from bursar import utils, cardbundle
 
 
 class Html5EmailInput(forms.widgets.Input):
@@ -14,6 +16,26 @@ class Html5TelInput(forms.widgets.Input):
     input_type = 'tel'
 
 
+class CardNumberInput(forms.TextInput):
+    """ Card number input detecting card type in the browser, with the script
+        built by cardbundle. Logos of accepted cards (see bursar.css) follow
+        the input and the one of the typed card gets card-selected class """
+    def __init__(self, attrs=None):
+        default_attrs = {'class': 'numeric', 'autocomplete': 'off', 'data-bursar-card': '1'}
+        default_attrs.update(attrs or {})
+        super(CardNumberInput, self).__init__(default_attrs)
+
+    @property
+    def media(self):
+        return forms.Media(js=[cardbundle.script_name()])
+
+    def render(self, name, value, attrs=None):
+        html = super(CardNumberInput, self).render(name, value, attrs)
+        logos = [u'<span class="card %s" data-card-type="%s"></span>' % (conditional_escape(card_type), conditional_escape(card_type))
+                 for card_type in self.attrs.get('data-accept', '').split(',') if card_type]
+        return mark_safe(html + u''.join(logos))
+
+
 class ExpirationDateWidget(forms.MultiWidget):
     def __init__(self, attrs=None):
         year = datetime.date.today().year
@@ -104,6 +126,12 @@ class CreditCardField(NumericField):
         self.max_num_length = reduce(lambda x, y: max(x,max(cards_dict[y][0])), self.accept_cards, self.min_num_length)
         self.widget.attrs['maxlength'] = self.max_num_length
 
+    def widget_attrs(self, widget):
+        attrs = super(CreditCardField, self).widget_attrs(widget)
+        if isinstance(widget, CardNumberInput):
+            attrs['data-accept'] = ','.join(sorted(self.accept_cards))
+        return attrs
+
     def validate(self, value):
         if value: # we don't know if this field is required
             card_no = str(value)
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from bursar import models as bursar_models
+from bursar import models as bursar_models, concurrency
 from bursar.gateway import base
 
 from . import PROCESSOR_KEY
@@ -9,11 +9,11 @@ class PaymentProcessor(base.BasePaymentProcessor):
     key = PROCESSOR_KEY
     can_authorize = True
 
-    def authorize(self, form_data):
+    def authorize(self, payment, form_data):
         self.log.debug('Authorize request: %s', form_data)
 
         bursar_models.CreditCardDetail(
-                payment= self.payment,
+                payment= payment,
                 ccv    = form_data['cvc'],
                 card_no= form_data['card_no'],
                 expiry = form_data['expiry'],
@@ -22,34 +22,53 @@ class PaymentProcessor(base.BasePaymentProcessor):
 
         return {
             'status' : 'A',
-            'amount' : self.payment.amount
+            'amount' : payment.amount
         }
 
-    def capture(self, form_data):
-        result = authorize(form_data)
+    def capture(self, payment, form_data):
+        result = self.authorize(payment, form_data)
         result['status'] = 'CD'
         return result
 
-    def capture_authorized(self, amount):
-        self.log.debug('Capture authorized request: %s, %s', self.payment, amount)
+    def capture_authorized(self, payment, amount):
+        self.log.debug('Capture authorized request: %s, %s', payment, amount)
         return {
             'status' : 'CD',
             'amount' : amount,
         }
 
-    def release_authorized(self):
-        self.log.debug('Release authorized request: %s', self.payment)
+    def release_authorized(self, payment):
+        self.log.debug('Release authorized request: %s', payment)
         return { 'status' : 'C' }
 
-    def refund(self, amount):
-        assert(amount <= self.payment.amount)
-        self.log.debug('Refund request: %s, %s', self.payment, amount)
+    def refund(self, payment, amount):
+        assert(amount <= payment.amount)
+        self.log.debug('Refund request: %s, %s', payment, amount)
 
-        new_amount = self.payment.amount - amount
+        new_amount = payment.amount - amount
         return {
             'amount' : new_amount,
-            'status' : self.payment.status if new_amount > 0 else 'RF'
+            'status' : payment.status if new_amount > 0 else 'RF'
         }
 
-    def get_payment_status(self):
+    def get_payment_status(self, payment):
         return {}
+
+    # nothing to wait for: results are resolved futures, no executor round trip
+    def aauthorize(self, payment, form_data):
+        return concurrency.completed(self.authorize, payment, form_data)
+
+    def acapture(self, payment, form_data):
+        return concurrency.completed(self.capture, payment, form_data)
+
+    def acapture_authorized(self, payment, amount):
+        return concurrency.completed(self.capture_authorized, payment, amount)
+
+    def arelease_authorized(self, payment):
+        return concurrency.completed(self.release_authorized, payment)
+
+    def arefund(self, payment, amount):
+        return concurrency.completed(self.refund, payment, amount)
+
+    def aget_payment_status(self, payment):
+        return concurrency.completed(self.get_payment_status, payment)
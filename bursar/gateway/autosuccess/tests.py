@@ -1,11 +1,15 @@
 # -*- coding: UTF-8 -*-
 """Bursar Autosucess Gateway Tests."""
+import datetime
 from bursar.gateway.autosuccess import processor
 from bursar.tests import make_test_purchase
+from bursar import models, concurrency
+from bursar import settings as bursar_settings
 from decimal import Decimal
 from django.conf import settings
 from django.test import TestCase
 from django.test.client import Client
+from django.utils import unittest
 
 class TestGateway(TestCase):
     def setUp(self):
@@ -25,3 +29,100 @@ class TestGateway(TestCase):
         self.assertEqual(payment.amount, Decimal('10.00'))
         self.assertEqual(purchase.total_payments, Decimal('10.00'))
         self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+
+    def test_lifecycle_writes(self):
+        """ number of queries per payment lifecycle step """
+        purchase = make_test_purchase(10)
+        payment = models.Payment(method='autosuccess', purchase=purchase, amount=10)
+        form_data = {
+            'name'   : 'John Smith',
+            'card_no': '4444333322221111',
+            'expiry' : datetime.date.today() + datetime.timedelta(days=400),
+            'cvc'    : '123',
+        }
+        # payment insert, card insert, payment update, note insert
+        self.assertNumQueries(4, payment.authorize, form_data)
+        # payment update, note insert
+        self.assertNumQueries(2, payment.capture_authorized, 5)
+        self.assertNumQueries(2, payment.refund, 2)
+        self.assertNumQueries(2, payment.cancel)
+        self.assertEqual(payment.status, 'RF')
+        self.assertRaises(ValueError, payment._update, {'status': 'A'})
+
+    def test_batch_capture(self):
+        purchase = make_test_purchase(10)
+        for amount in (3, 3, 4):
+            models.Payment.objects.create(method='autosuccess', purchase=purchase, amount=amount, status='A')
+        # select, one update for all payments, bulk insert of notes
+        with self.assertNumQueries(3):
+            captured = models.Payment.objects.capture_authorized_many(purchase.payments.all())
+        self.assertEqual(len(captured), 3)
+        self.assertEqual(purchase.payments.filter(status='CD').count(), 3)
+        self.assertEqual(models.PaymentNote.objects.filter(payment__purchase=purchase).count(), 3)
+
+    @unittest.skipIf(concurrency.futures is None, 'futures package is not installed')
+    def test_async(self):
+        """ autosuccess processor resolves futures right away """
+        payment = models.Payment(method='autosuccess', amount=10, status='A')
+        future = self.gateway.acapture_authorized(payment, 5)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), {'status': 'CD', 'amount': 5})
+        self.assertRaises(AssertionError, self.gateway.arefund(payment, 20).result)
+
+    def test_purchase_fan_out(self):
+        """ purchase operations spread amounts over payments in order, whether
+            gateway calls run one by one or concurrently """
+        saved_concurrency = bursar_settings.PURCHASE_CONCURRENCY
+        try:
+            for limit in (1, 4):
+                bursar_settings.PURCHASE_CONCURRENCY = limit
+                purchase = make_test_purchase(10)
+                payments = [models.Payment.objects.create(method='autosuccess', purchase=purchase, amount=amount, status='A')
+                            for amount in (3, 3, 4)]
+                captured = purchase.capture_authorized(5)
+                self.assertEqual(sorted(captured.values_list('id', 'amount')), [(payments[0].id, 3), (payments[1].id, 2)])
+                self.assertEqual(purchase.captured_amount, 5)
+                self.assertEqual(purchase.authorized_amount, 4)
+
+                refunded = purchase.refund(4)
+                self.assertEqual(sorted(refunded.values_list('id', 'status')), [(payments[0].id, 'RF'), (payments[1].id, 'CD')])
+                self.assertEqual(purchase.captured_amount, 1)
+
+                self.assertEqual(sorted(purchase.cancel().values_list('id', 'status')), [(payments[1].id, 'RF'), (payments[2].id, 'C')])
+                self.assertEqual(purchase.captured_amount, 0)
+                self.assertEqual(purchase.authorized_amount, 0)
+        finally:
+            bursar_settings.PURCHASE_CONCURRENCY = saved_concurrency
+
+    def test_job(self):
+        """ admin actions run as jobs on chunks of payments """
+        from bursar import jobs, admin
+        purchase = make_test_purchase(10)
+        ids = [models.Payment.objects.create(method='autosuccess', purchase=purchase, amount=1, status=status).id
+               for status in ('A', 'A', 'A', 'CD', 'C')]
+        state = {'name': 'cancel', 'total': len(ids), 'done': 0, 'changed': 0, 'error': None, 'finished': False}
+        jobs._run('test', state, admin._cancel, ids, chunk_size=2)
+        self.assertEqual(state, dict(state, done=5, changed=4, error=None, finished=True))
+        self.assertEqual(jobs.progress('test'), state)
+        self.assertEqual(purchase.payments.filter(status__in=('C', 'RF')).count(), 5)
+
+    def test_reconcile(self):
+        import os, tempfile
+        from bursar.reconcile import Reconciler
+        purchase = make_test_purchase(10)
+        for status in ('A', 'CD', 'C', 'A'):
+            models.Payment.objects.create(method='autosuccess', purchase=purchase, amount=1, status=status)
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reconcile.json')
+        stats = Reconciler(purchase.payments.all(), rate=0, batch_size=2, checkpoint=checkpoint).run()
+        self.assertEqual((stats['checked'], stats['changed'], stats['errors']), (3, 0, 0))
+        # complete run starts over next time
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Reconciler(purchase.payments.all(), checkpoint=checkpoint).run()['checked'], 3)
+
+        # interrupted run resumes after the last reconciled payment
+        def interrupt(stats):
+            raise KeyboardInterrupt
+        reconciler = Reconciler(purchase.payments.all(), rate=0, batch_size=2, checkpoint=checkpoint, progress=interrupt)
+        self.assertRaises(KeyboardInterrupt, reconciler.run)
+        self.assertEqual(Reconciler(purchase.payments.all(), checkpoint=checkpoint).run()['checked'], 1)
+        self.assertFalse(os.path.exists(checkpoint))
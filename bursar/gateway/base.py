@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import os, logging
 
-from .. import signals, models
+from .. import signals, models, concurrency, metrics
+from . import breaker
 from .. import settings as bursar_settings
 
 from django.utils.translation import ugettext_lazy as _
@@ -10,51 +11,93 @@ from django.core.exceptions import ImproperlyConfigured
 
 log = logging.getLogger('bursar.gateway.base')
 
+class InstrumentedProcessor(type):
+    """ times gateway operations defined by processor classes, see metrics.py """
+    def __new__(mcs, name, bases, attrs):
+        for operation in metrics.OPERATIONS:
+            if operation in attrs:
+                attrs[operation] = metrics.instrument(operation, attrs[operation])
+        return super(InstrumentedProcessor, mcs).__new__(mcs, name, bases, attrs)
+
 class BasePaymentProcessor(object):
+    """ Processors are stateless: one instance per gateway is shared by all
+        payments and threads (see utils.get_processor_instance), so payment is
+        passed to every call and nothing payment specific is stored on self """
+    __metaclass__ = InstrumentedProcessor
     key = None # should be overriden in descendants. possible values: authorizenet, dummy, autosuccess etc
     settings = {}
     require_settings = []
 
-    def __init__(self, payment):
+    def __init__(self):
         if not self.key:
             raise ImproperlyConfigured("You should override self.key in payment processors")
+        self.settings = dict(self.settings)
         self.settings.update(bursar_settings.gateway(self.key))
 
         for s in self.require_settings:
             if not self.settings.get(s):
                 raise ImproperlyConfigured('You must define a %(setting_name)s for the %(payment_module)s payment module.' % {'setting_name':s, 'payment_module':self.key})
 
-        self.payment = payment
         self.log = logging.getLogger('bursar.gateway.' + self.key)
+        self.breaker = breaker.get_breaker(self.key, self.settings)
 
     can_authorize = False
 
-    def authorize(self, form_data):
+    def authorize(self, payment, form_data):
         """ Authorize a single payment """
         if not self.can_authorize:
-            return self.capture(amount, form_data)
-        raise NotImplementedErorr
+            return self.capture(payment, form_data)
+        raise NotImplementedError
 
-    def capture(self, form_data):
+    def capture(self, payment, form_data):
         """ Capture a single payment """
-        raise NotImplementedErorr
+        raise NotImplementedError
 
-    def capture_authorized(self, amount):
+    def capture_authorized(self, payment, amount):
         """ Capture previously authorized payment """
-        raise NotImplemented
+        raise NotImplementedError
 
-    def release_authorized(self):
+    def release_authorized(self, payment):
         """ Capture previously authorized payment """
-        raise NotImplemented
+        raise NotImplementedError
 
-    def refund(self, amount):
+    def refund(self, payment, amount):
         """Release previously authorized or refund captured payment """
         raise NotImplementedError
 
-    def get_payment_status(self):
+    def get_payment_status(self, payment):
         """ Only some processors have such an option. Fall silently """
         return {}
 
+    # Batch modifications: [(payment, amount), ..] or [payment, ..] for release.
+    # Return {payment.id: result} for successfully modified payments only.
+    # Gateways supporting batch requests should override these
+    def capture_authorized_many(self, modifications):
+        return self._modify_each(self.capture_authorized, modifications)
+
+    def release_authorized_many(self, payments):
+        return self._modify_each(self.release_authorized, [(payment,) for payment in payments])
+
+    def refund_many(self, modifications):
+        return self._modify_each(self.refund, modifications)
+
+    def _modify_each(self, method, modifications):
+        results = {}
+        for args in modifications:
+            try:
+                results[args[0].id] = method(*args)
+            except Exception:
+                self.log.exception('%s failed for %s', method.__name__, args[0])
+        return results
+
+    # asynchronous API, run in bursar executor by default
+    aauthorize          = concurrency.async_method('authorize')
+    acapture            = concurrency.async_method('capture')
+    acapture_authorized = concurrency.async_method('capture_authorized')
+    arelease_authorized = concurrency.async_method('release_authorized')
+    arefund             = concurrency.async_method('refund')
+    aget_payment_status = concurrency.async_method('get_payment_status')
+
     def log_extra(self, msg, *args, **kwargs):
         """ generic Satchmo gateway method. Kept for compatibility """
         self.log.debug("(Extra logging) " + msg, *args, **kwargs)
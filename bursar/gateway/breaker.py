@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Per-gateway circuit breaker. While a gateway keeps failing, requests fail fast
+with GatewayError instead of tying up workers until they time out:
+
+    self.breaker.before()   # raises GatewayError if open
+    try:
+        response = send(...)
+    except NetworkError:
+        self.breaker.failure()
+        raise
+    self.breaker.success()
+"""
+import time
+import threading
+import collections
+
+from bursar.errors import GatewayError
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+class CircuitBreaker(object):
+    """ Opens when at least `min_requests` of the last `window` calls were made
+        and more than `threshold` (0..1) of them failed. After `reset_timeout`
+        seconds it half-opens: a single trial call is let through, its success
+        closes the breaker and its failure opens it again """
+    def __init__(self, name, threshold=0.5, window=20, min_requests=10, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.outcomes = collections.deque(maxlen=window) # True for failures
+        self.state = CLOSED
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def before(self):
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN # this caller makes the trial call
+                return
+        if self.state != CLOSED:
+            raise GatewayError('%s is unavailable, circuit breaker is %s' % (self.name, self.state))
+
+    def success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.outcomes.clear()
+            self.outcomes.append(False)
+
+    def failure(self):
+        with self._lock:
+            self.outcomes.append(True)
+            if self.state == HALF_OPEN or (len(self.outcomes) >= self.min_requests and
+                    float(sum(self.outcomes)) / len(self.outcomes) > self.threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name, settings):
+    """ process wide breaker of gateway `name`, configured by its settings """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name,
+                        threshold     = settings.get('BREAKER_THRESHOLD', 0.5),
+                        window        = settings.get('BREAKER_WINDOW', 20),
+                        min_requests  = settings.get('BREAKER_MIN_REQUESTS', 10),
+                        reset_timeout = settings.get('BREAKER_RESET_TIMEOUT', 30),
+                    )
+    return breaker
@@ -18,4 +18,44 @@ DEFAULT_SETTINGS = {
         ('MAESTRO', 'Maestro'),
     ),
     'PREFIX'          : '',
+    # 'template' renders worldpay/*.xml templates; 'lxml' builds the same
+    # documents in code (faster), see builder.py
+    'REQUEST_BUILDER' : 'template',
+    # orders per batch capture/cancel/refund request. Batches of more are not
+    # confirmed against the live gateway; rejected ones are sent one by one
+    'MAX_BATCH_MODIFICATIONS': 1,
+    # request/response capture into RequestResponse, see capture.py
+    # Test mode traffic is captured in full, LIVE traffic at CAPTURE_SAMPLE_RATE
+    'CAPTURE_SAMPLE_RATE': 0,       # 0..1, eg 0.001 to keep every thousandth LIVE request
+    'CAPTURE_QUEUE_SIZE' : 1000,    # pairs waiting to be written, more are dropped
+    'CAPTURE_BATCH_SIZE' : 100,     # rows per bulk insert
+    'CAPTURE_DATABASE'   : None,    # database alias, None for default routing
+    # status_update callback, see notifications.py
+    'NOTIFICATION_NETWORKS' : ('195.35.90.0/23',), # CIDRs notifications are accepted from, Worldpay's by default
+    'NOTIFICATION_HOSTS'    : ('rbsworldpay.com',), # more addresses, resolved in background
+    'NOTIFICATION_REFRESH'  : 3600, # seconds between host lookups
+    'NOTIFICATION_DEDUP_TIMEOUT': 86400, # seconds repeated notifications are dropped for
+    # keep-alive connection pool, see pool.ConnectionPool
+    # max concurrent requests per process. Other callers wait for a free
+    # connection up to their connect timeout, so this caps FANOUT_WORKERS,
+    # EXECUTOR_WORKERS and reconcile --workers making Worldpay requests
+    'POOL_SIZE'       : 16,
+    'CONNECT_TIMEOUT' : 10, # seconds
+    'READ_TIMEOUT'    : 60, # seconds
+    'IDLE_TIMEOUT'    : 30, # seconds, should be below server keep-alive timeout
+    # per operation (connect, read) timeouts, seconds. Others use CONNECT_TIMEOUT and READ_TIMEOUT
+    'TIMEOUTS'        : {
+        'authorize'         : (10, 60),
+        'capture_authorized': (10, 30),
+        'release_authorized': (10, 30),
+        'refund'            : (10, 30),
+        'get_payment_status': (5, 15),
+    },
+    'RETRIES'         : 2,   # extra attempts of idempotent requests (status inquiries)
+    'RETRY_BACKOFF'   : 0.2, # seconds, random delay up to RETRY_BACKOFF * 2**attempt
+    # circuit breaker, see bursar/gateway/breaker.py
+    'BREAKER_THRESHOLD'    : 0.5, # share of failed requests opening the breaker
+    'BREAKER_WINDOW'       : 20,  # last requests looked at
+    'BREAKER_MIN_REQUESTS' : 10,  # don't open on fewer requests than this
+    'BREAKER_RESET_TIMEOUT': 30,  # seconds before a trial request is let through
 }
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+lxml based builders of Worldpay paymentService requests, producing the same
+documents as worldpay/*.xml templates (modulo whitespace) without template
+lookup and rendering. Enabled by 'REQUEST_BUILDER': 'lxml' in WORLDPAY settings;
+templates not listed in BUILDERS (or customized ones) are rendered as before.
+"""
+from lxml import etree
+
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
+
+from .templatetags.worldpay_tags import amount as minor_units
+
+HEADER = u'<?xml version="1.0"?>\n' \
+         u'<!DOCTYPE paymentService PUBLIC "-//RBS WorldPay//DTD RBS WorldPay PaymentService v1//EN" ' \
+         u'"http://dtd.wp3.rbsworldpay.com/paymentService_v1.dtd">\n'
+
+def resolve(obj, *path):
+    """ Template-like variable lookup: dict key or attribute, '' if missing """
+    for bit in path:
+        try:
+            obj = obj[bit]
+        except (TypeError, KeyError, AttributeError, IndexError):
+            try:
+                obj = getattr(obj, bit)
+            except AttributeError:
+                return u''
+    return obj
+
+text = force_unicode
+
+def sub(parent, tag, content=None, **attrib):
+    node = etree.SubElement(parent, tag, attrib)
+    if content is not None:
+        node.text = text(content)
+    return node
+
+def sub_if(parent, tag, content):
+    """ {% if content %}<tag>{{ content }}</tag>{% endif %} """
+    if content:
+        return sub(parent, tag, content)
+
+def order_code(payment):
+    return text(payment.transaction_id or payment.id)
+
+def service(vars):
+    return etree.Element('paymentService', version='1.4', merchantCode=text(vars['MERCHANT_ID']))
+
+def to_string(root):
+    return HEADER + etree.tostring(root, encoding=unicode)
+
+def amount_node(parent, amount, vars):
+    return sub(parent, 'amount', value=text(minor_units(amount)), currencyCode=text(vars['currency']), exponent='2')
+
+def modify(vars):
+    root = service(vars)
+    modification = sub(sub(root, 'modify'), 'orderModification', orderCode=order_code(vars['payment']))
+    return root, modification
+
+def address_node(parent, first_name, last_name, street, house_name, postal_code, city, country, phone, phone_optional=False):
+    address = sub(parent, 'address')
+    sub_if(address, 'firstName', first_name)
+    sub_if(address, 'lastName', last_name)
+    sub(address, 'street', street)
+    sub_if(address, 'houseName', house_name)
+    sub(address, 'postalCode', postal_code)
+    sub(address, 'city', city)
+    sub(address, 'countryCode', country)
+    if phone_optional:
+        sub_if(address, 'telephoneNumber', phone)
+    else:
+        sub(address, 'telephoneNumber', phone)
+    return address
+
+def authorize(vars):
+    payment   = vars['payment']
+    form_data = vars['form_data']
+    request   = vars.get('request')
+    field = lambda name: resolve(form_data, name)
+
+    root = service(vars)
+    order = sub(sub(root, 'submit'), 'order', orderCode=order_code(payment))
+    sub(order, 'description', payment.purchase)
+    amount_node(order, payment.amount, vars)
+    sub(order, 'orderContent').text = etree.CDATA(u''.join(
+            u'\n                    %s\n            ' % conditional_escape(lineitem) for lineitem in payment.purchase))
+
+    details = sub(order, 'paymentDetails')
+    method = sub(details, vars['payment_method'])
+    sub(method, 'cardNumber', field('card_no'))
+    expiry = field('expiry')
+    if expiry:
+        sub(sub(method, 'expiryDate'), 'date', month=expiry.strftime('%m'), year=expiry.strftime('%Y'))
+    sub(method, 'cardHolderName', field('name'))
+    sub_if(method, 'cvc', field('cvc'))
+    sub_if(method, 'issueNumber', field('issue_num'))
+    address_node(sub(method, 'cardAddress'), field('first_name'), field('last_name'), field('address'),
+            field('address2'), field('zip'), field('city'), resolve(form_data, 'country', 'code'), field('phone'))
+    sub(details, 'session', shopperIPAddress=text(resolve(request, 'META', 'REMOTE_ADDR')),
+            id=text(resolve(request, 'session', 'session_key')))
+
+    shopper = sub(order, 'shopper')
+    sub(shopper, 'shopperEmailAddress', field('email'))
+    browser = sub(shopper, 'browser')
+    sub(browser, 'acceptHeader', resolve(request, 'META', 'HTTP_ACCEPT'))
+    sub(browser, 'userAgentHeader', resolve(request, 'META', 'HTTP_USER_AGENT'))
+
+    shipping_address = payment.purchase.shipping_address
+    if shipping_address:
+        address = lambda name: resolve(shipping_address, name)
+        address_node(sub(order, 'shippingAddress'), address('first_name'), address('last_name'),
+                address('street_address1'), address('street_address2'), address('postal_code'),
+                address('city'), address('country'), address('phone'), phone_optional=True)
+
+    return to_string(root)
+
+def capture_authorized(vars):
+    root, modification = modify(vars)
+    amount_node(sub(modification, 'capture'), vars['amount'], vars)
+    return to_string(root)
+
+def refund(vars):
+    root, modification = modify(vars)
+    amount_node(sub(modification, 'refund'), vars['amount'], vars)
+    return to_string(root)
+
+def release_authorized(vars):
+    root, modification = modify(vars)
+    sub(modification, 'cancel')
+    return to_string(root)
+
+def modify_batch(vars):
+    root = service(vars)
+    modify = sub(root, 'modify')
+    for modification in vars['modifications']:
+        node = sub(modify, 'orderModification', orderCode=order_code(modification['payment']))
+        if vars['action'] == 'cancel':
+            sub(node, 'cancel')
+        else:
+            amount_node(sub(node, vars['action']), modification['amount'], vars)
+    return to_string(root)
+
+def get_status(vars):
+    root = service(vars)
+    sub(sub(root, 'inquiry'), 'orderInquiry', orderCode=order_code(vars['payment']))
+    return to_string(root)
+
+BUILDERS = {
+    'worldpay/authorize.xml'         : authorize,
+    'worldpay/capture_authorized.xml': capture_authorized,
+    'worldpay/refund.xml'            : refund,
+    'worldpay/release_authorized.xml': release_authorized,
+    'worldpay/modify_batch.xml'      : modify_batch,
+    'worldpay/get_status.xml'        : get_status,
+}
+
+def normalize(request_text):
+    """ canonical form of request document, ignoring insignificant whitespace """
+    if isinstance(request_text, unicode):
+        request_text = request_text.encode('utf8')
+    parser = etree.XMLParser(remove_blank_text=True, strip_cdata=False)
+    return etree.tostring(etree.fromstring(request_text, parser), method='c14n')
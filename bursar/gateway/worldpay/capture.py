@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind capture of request/response pairs into RequestResponse.
+Requests are redacted in the calling thread, put into a bounded in-memory
+queue and written by a background thread with bulk inserts, so payment
+requests never wait for the database. In LIVE mode only a configurable sample
+of traffic is captured.
+"""
+import os
+import re
+import time
+import Queue
+import random
+import atexit
+import logging
+import threading
+
+from lxml import etree
+
+from django.db import transaction
+
+from bursar import settings as bursar_settings
+
+from . import models
+
+log = logging.getLogger('bursar.gateway.worldpay.capture')
+
+CARD_NUMBER_RE = re.compile(r'(<cardNumber>\s*)(\d*?)(\d{0,4})(\s*</cardNumber>)')
+CVC_RE = re.compile(r'(<cvc>)[^<]*(</cvc>)')
+
+def redact(text):
+    """ mask card numbers (all but last 4 digits) and CVCs """
+    text = CARD_NUMBER_RE.sub(lambda m: m.group(1) + '*'*len(m.group(2)) + m.group(3) + m.group(4), text)
+    return CVC_RE.sub(r'\1***\2', text)
+
+def pretty_print(response_text):
+    try:
+        return etree.tostring(etree.fromstring(response_text), pretty_print=True)
+    except etree.XMLSyntaxError:
+        return response_text
+
+class CapturePipeline(object):
+    def __init__(self, sample_rate=1.0, queue_size=1000, batch_size=100, database=None):
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.database = database
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self._writer = None
+        self._writer_pid = None
+        self._lock = threading.Lock()
+
+    def sampled(self):
+        """ should this request be captured? Test mode traffic is captured in full """
+        if not bursar_settings.LIVE:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def put(self, request_text, response_text):
+        """ queue redacted pair for writing; drops it if the queue is full """
+        if isinstance(request_text, unicode):
+            request_text = request_text.encode('utf8')
+        try:
+            self.queue.put_nowait((redact(request_text), redact(response_text or ''), bursar_settings.LIVE))
+        except Queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer_pid != os.getpid():
+            with self._lock:
+                if self._writer is None or self._writer_pid != os.getpid():
+                    self._writer = threading.Thread(target=self._run, name='bursar-worldpay-capture')
+                    self._writer.daemon = True
+                    self._writer_pid = os.getpid()
+                    self._writer.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception:
+                log.exception('Failed to write %s captured request(s)', len(batch))
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    def write(self, batch):
+        rows = [models.RequestResponse(request=request, response=pretty_print(response), https=https)
+                for request, response, https in batch]
+        with transaction.commit_on_success(using=self.database):
+            models.RequestResponse.objects.using(self.database).bulk_create(rows)
+
+    def flush(self, timeout=5):
+        """ wait until queued pairs are written, eg before showing them """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def get_pipeline(settings):
+    """ process wide capture pipeline configured by gateway settings """
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = CapturePipeline(
+                        sample_rate = settings.get('CAPTURE_SAMPLE_RATE', 0),
+                        queue_size  = settings.get('CAPTURE_QUEUE_SIZE', 1000),
+                        batch_size  = settings.get('CAPTURE_BATCH_SIZE', 100),
+                        database    = settings.get('CAPTURE_DATABASE'),
+                    )
+                atexit.register(_pipeline.flush)
+    return _pipeline
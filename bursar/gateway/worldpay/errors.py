@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+from bursar.errors import GatewayError
 
-class WorldpayError(Exception):
+class WorldpayError(GatewayError):
     def __init__(self, message, Errors=None):
         Exception.__init__(self, message)
         self.Errors = Errors or ()
+
+class WorldpayNetworkError(WorldpayError):
+    """ request did not get a paymentService reply: HTTP error, timeout, dropped connection """
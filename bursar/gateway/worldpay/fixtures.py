@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Sample request, form data and payment for tests and benchmarks
+"""
+import datetime
+
+class default_request:
+    class META:
+        REMOTE_ADDR = '194.61.183.122'
+        HTTP_ACCEPT = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+        HTTP_USER_AGENT = 'Mozilla/5.0 (X11; Linux i686; rv:7.0.1) Gecko/20100101 Firefox/7.0.1'
+    class session:
+        session_key = '0938209340293842938492348209348'
+
+default_form_data = {
+        'name'    : 'John Smith',
+        'address' : 'Baker st, 221b',
+        'city'    : 'London',
+        'zip'     : 'NW1',
+        'country' : 'GB',
+        'phone'   : '7935-8866',
+        'email'   : 'testuser@test.com',
+        'card_no' : '4444333322221111',
+        'card_type' : 'VISA',
+        'expiry'  : datetime.date.today() + datetime.timedelta(days=400),
+        'cvc'     : '123',
+        'request' : default_request,
+    }
+
+class test_purchase(object):
+    shipping_address = {
+        'first_name' : 'John',
+        'street_address1' : 'Baker st, 221b',
+        'city'       : 'London',
+        'postal_code': 'NW1',
+        'country'    : 'GB',
+    }
+    def __unicode__(self):
+        return u'Order #15 for Smith & Sons'
+    def __iter__(self):
+        return iter([u'2 x Tea <Earl Grey>', u'1 x Milk'])
+
+class test_payment(object):
+    id = 15
+    transaction_id = ''
+    amount = 10.5
+    purchase = test_purchase()
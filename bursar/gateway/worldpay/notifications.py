@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for status_update (order notification) callback: source address
+allowlist, duplicate detection and one-query status apply.
+"""
+import time
+import socket
+import struct
+import logging
+import threading
+
+from django.core.cache import cache
+
+from bursar import models as bursar_models
+
+from . import processor
+
+log = logging.getLogger('bursar.gateway.worldpay.notifications')
+
+def ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def parse_network(cidr):
+    """ '195.35.90.0/23' => (network, mask) integers """
+    address, _, bits = cidr.partition('/')
+    mask = (0xffffffff << (32 - int(bits or 32))) & 0xffffffff
+    return ip_to_int(address) & mask, mask
+
+class Allowlist(object):
+    """ Precomputed networks notifications are accepted from. Configured
+        NOTIFICATION_NETWORKS are static, NOTIFICATION_HOSTS are added by a
+        background thread (see start()) every NOTIFICATION_REFRESH seconds,
+        so requests never wait for DNS """
+    def __init__(self, networks=(), hosts=(), refresh=3600):
+        self.static = [parse_network(cidr) for cidr in networks]
+        self.hosts = hosts
+        self.refresh = refresh
+        self.addresses = frozenset()
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, address):
+        try:
+            address = ip_to_int(address)
+        except (socket.error, TypeError):
+            return False
+        if address in self.addresses:
+            return True
+        for network, mask in self.static:
+            if address & mask == network:
+                return True
+        return False
+
+    def resolve(self):
+        addresses = set()
+        for host in self.hosts:
+            try:
+                addresses.update(ip_to_int(info[4][0]) for info in
+                        socket.getaddrinfo(host, 80, socket.AF_INET, 0, socket.SOL_TCP))
+            except socket.error:
+                log.warning('Could not resolve %s', host)
+        if addresses:
+            self.addresses = frozenset(addresses) # atomic swap, readers need no lock
+
+    def start(self):
+        """ starts resolving hosts in background, once """
+        if self._refresher is None and self.hosts:
+            with self._lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._run, name='bursar-worldpay-allowlist')
+                    self._refresher.daemon = True
+                    self._refresher.start()
+
+    def _run(self):
+        while True:
+            self.resolve()
+            time.sleep(self.refresh)
+
+_allowlist = None
+_allowlist_lock = threading.Lock()
+
+def get_allowlist(settings):
+    """ process wide allowlist, resolving hosts from its creation on. PaymentProcessor
+        creates it in LIVE mode, so lookups run before the first notification comes """
+    global _allowlist
+    if _allowlist is None:
+        with _allowlist_lock:
+            if _allowlist is None:
+                allowlist = Allowlist(settings.get('NOTIFICATION_NETWORKS', ()),
+                                      settings.get('NOTIFICATION_HOSTS', ()),
+                                      settings.get('NOTIFICATION_REFRESH', 3600))
+                allowlist.start()
+                _allowlist = allowlist
+    return _allowlist
+
+def is_duplicate(payment_id, status_code, amount, timeout):
+    """ True if the same notification was already seen. Single cache.add """
+    return not cache.add('bursar.worldpay.notification:%s:%s:%s' % (payment_id, status_code, amount), 1, timeout)
+
+def forget(payment_id, status_code, amount):
+    """ allow notification to be processed again, eg after failure """
+    cache.delete('bursar.worldpay.notification:%s:%s:%s' % (payment_id, status_code, amount))
+
+# statuses a payment can be moved from to get each status
+SOURCES = dict((status, frozenset(source for source, targets in bursar_models.TRANSITIONS.items()
+                                  if status in targets and source != status))
+               for status in bursar_models.TRANSITIONS)
+
+def apply(payment_id, status_code, amount):
+    """ Applies notification with a conditional UPDATE: only payments in a
+        status the new one can be reached from are changed. Failing that, a
+        payment already in the status gets the new amount, eg partial refund.
+        Returns True if payment was changed """
+    status = processor.STATUSES.get(status_code)
+    if status is None:
+        log.warning('Unknown status %s in notification for payment %s', status_code, payment_id)
+        return False
+
+    payments = bursar_models.Payment.objects
+    with bursar_models.atomic(using=payments.db):
+        if payments.filter(pk=payment_id, status__in=SOURCES[status]).update(status=status, amount=amount):
+            note = "status: => %s\namount: => %s (notification)" % (bursar_models.STATE_NAMES[status], amount)
+        elif payments.filter(pk=payment_id, status=status).exclude(amount=amount).update(amount=amount):
+            note = "amount: => %s (notification)" % amount
+        else:
+            return False
+        bursar_models.PaymentNote.objects.create(payment_id=payment_id, note=note)
+    return True
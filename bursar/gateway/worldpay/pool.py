@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process pool of keep-alive HTTP(S) connections to Worldpay paymentService.
+Saves TCP+TLS handshake on every authorization, capture, refund etc.
+"""
+import time
+import base64
+import select
+import socket
+import httplib
+import urlparse
+import threading
+
+from . import errors
+
+class ConnectionPool(object):
+    """ Thread safe pool of persistent connections to a single service url.
+        At most `size` requests are in flight at once, idle connections are
+        reused most recently used first and closed after `idle_timeout` seconds.
+        Callers wait for a free slot up to their connect timeout, so `size`
+        caps concurrency of every worker pool making requests (FANOUT_WORKERS,
+        EXECUTOR_WORKERS, reconcile workers) """
+
+    def __init__(self, url, username, password, size=16, connect_timeout=10, read_timeout=60, idle_timeout=30):
+        parts = urlparse.urlsplit(url)
+        self.connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+
+        self.headers = {
+                "Authorization" : "Basic %s"%base64.b64encode(":".join([username, password])),
+                "Content-Type"  : "text/xml; charset=utf-8",
+            }
+
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+
+        self._idle = [] # [(connection, released_at), ..], most recently used last
+        self._lock = threading.Lock()
+        self._free_slots = size
+        self._slot_released = threading.Condition(self._lock)
+
+    def _get_connection(self, connect_timeout, read_timeout):
+        """ returns (connection, reused) """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                connection, released_at = self._idle.pop()
+                # readable idle connection was closed by the server (or is out of sync)
+                if now - released_at < self.idle_timeout and not select.select([connection.sock], [], [], 0)[0]:
+                    connection.sock.settimeout(read_timeout)
+                    return connection, True
+                connection.close()
+
+        connection = self.connection_class(self.host, self.port, timeout=connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(read_timeout)
+        return connection, False
+
+    def _put_connection(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.time()))
+
+    def _acquire_slot(self, timeout):
+        deadline = time.time() + timeout
+        with self._slot_released:
+            while not self._free_slots:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise errors.WorldpayNetworkError('No connection free in %ss, %s requests in flight'
+                                                      % (timeout, self.size))
+                self._slot_released.wait(remaining)
+            self._free_slots -= 1
+
+    def _release_slot(self):
+        with self._slot_released:
+            self._free_slots += 1
+            self._slot_released.notify()
+
+    def post(self, body, handler=None, connect_timeout=None, read_timeout=None, idempotent=False):
+        """ POST body to the service url. Returns response text, or
+            handler(response) if handler is given - eg to parse response stream.
+            Timeouts (seconds) default to the pool ones; waiting for a free
+            slot counts as connecting.
+            If a reused connection turns out to be dropped, the request is sent
+            again on a fresh one only if it was not sent yet, or is idempotent:
+            a dropped response doesn't tell whether Worldpay processed it """
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        connect_timeout = connect_timeout or self.connect_timeout
+        read_timeout = read_timeout or self.read_timeout
+
+        self._acquire_slot(connect_timeout)
+        try:
+            while True:
+                connection, reused = self._get_connection(connect_timeout, read_timeout)
+                sent = False
+                try:
+                    connection.request('POST', self.path, body, self.headers)
+                    sent = True
+                    response = connection.getresponse()
+                    break
+                except (socket.error, httplib.BadStatusLine), e:
+                    connection.close()
+                    if not reused or isinstance(e, socket.timeout) or (sent and not idempotent):
+                        raise
+                    # keep-alive connection was dropped by the server while idle
+                except:
+                    connection.close()
+                    raise
+
+            try:
+                if response.status != 200:
+                    raise errors.WorldpayNetworkError('HTTP error %s: %s'%(response.status, response.reason))
+                result = handler(response) if handler else response.read()
+                response.read() # connection can't be reused until response is read
+            except:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(connection)
+        finally:
+            self._release_slot()
+
+        return result
+
+    def close(self):
+        """ close all idle connections """
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(url, settings):
+    """ returns process wide pool for url and gateway settings """
+    key = (url, settings['MERCHANT_ID'], settings['XML_PASSWORD'])
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(url, settings['MERCHANT_ID'], settings['XML_PASSWORD'],
+                        size            = settings.get('POOL_SIZE', 16),
+                        connect_timeout = settings.get('CONNECT_TIMEOUT', 10),
+                        read_timeout    = settings.get('READ_TIMEOUT', 60),
+                        idle_timeout    = settings.get('IDLE_TIMEOUT', 30),
+                    )
+    return pool
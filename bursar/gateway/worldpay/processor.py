@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
-import base64
-import urllib2
+import time
+import random
+import socket
+import httplib
+import logging
 from lxml import etree
 
 from bursar import models as bursar_models
 from bursar import settings as bursar_settings
+from bursar import metrics
+from bursar import utils
 from bursar.gateway import base
+from bursar.errors import GatewayError
 
 from django.template import loader as template_loader
 
-from . import PROCESSOR_KEY, models, errors
+from . import PROCESSOR_KEY, errors, pool, builder, capture
 
 PAYMENT_METHOD_CODES = {
     # credit cards
@@ -53,6 +59,38 @@ STATUSES = {
     'CHARGEBACK_REVERSED': 'S',
 }
 
+# template => operation, for per operation timeouts and retries
+TEMPLATE_OPERATIONS = {
+    'worldpay/authorize.xml'         : 'authorize',
+    'worldpay/capture_authorized.xml': 'capture_authorized',
+    'worldpay/release_authorized.xml': 'release_authorized',
+    'worldpay/refund.xml'            : 'refund',
+    'worldpay/get_status.xml'        : 'get_payment_status',
+    'worldpay/modify_batch.xml'      : 'modify_batch',
+}
+# safe to send again if reply was lost
+IDEMPOTENT = ('get_payment_status',)
+
+NETWORK_ERRORS = (socket.error, httplib.HTTPException, errors.WorldpayNetworkError)
+
+# XPath expressions are compiled once, not on every response
+REPLY               = etree.XPath('/paymentService/reply')
+REPLY_ERRORS        = etree.XPath('./error')
+ORDER_PAYMENT       = etree.XPath('./orderStatus/payment')
+STATUS_PAYMENT      = etree.XPath('./payment')
+CAPTURE_AMOUNT      = etree.XPath('./ok/captureReceived/amount')
+CANCEL_RECEIVED     = etree.XPath('./ok/cancelReceived')
+REFUND_AMOUNT       = etree.XPath('./ok/refundReceived/amount')
+RECEIVED            = {
+    'capture': etree.XPath('.//captureReceived'),
+    'cancel' : etree.XPath('.//cancelReceived'),
+    'refund' : etree.XPath('.//refundReceived'),
+}
+BALANCE             = etree.XPath('./balance')
+AMOUNT              = etree.XPath('./amount')
+LAST_EVENT          = etree.XPath('./lastEvent/text()')
+RETURN_DESCRIPTION  = etree.XPath('./ISO8583ReturnCode/@description')
+
 def get_first(iterable, default=None):
     if not iterable:
         return default
@@ -65,10 +103,8 @@ def get_amount(amount_node):
     if amount_node is None:
         return None
     try:
-        value = int(amount_node.attrib.get('value'))
-        exp  = int(amount_node.attrib.get('exponent'))
-        return value*(10**-exp)
-    except ValueError:
+        return utils.from_minor_units(amount_node.attrib.get('value'), amount_node.attrib.get('exponent'))
+    except (TypeError, ValueError):
         return None
 
 class PaymentProcessor(base.BasePaymentProcessor):
@@ -76,30 +112,45 @@ class PaymentProcessor(base.BasePaymentProcessor):
     require_settings = ('MERCHANT_ID', 'XML_PASSWORD')
     can_authorize = True
 
-    def __init__(self, payment):
-        super(PaymentProcessor, self).__init__(payment)
+    def __init__(self):
+        super(PaymentProcessor, self).__init__()
         self.connection = self.settings['SERVICE_URL' if bursar_settings.LIVE else 'TEST_SERVICE_URL']
-
-    def authorize(self, form_data):
+        self.pool = pool.get_pool(self.connection, self.settings)
+        # templates to be built by lxml instead of rendering, see builder.py
+        self.builders = builder.BUILDERS if self.settings.get('REQUEST_BUILDER') == 'lxml' else {}
+        self.capture_pipeline = capture.get_pipeline(self.settings)
+        if bursar_settings.LIVE:
+            from . import notifications # imports this module
+            notifications.get_allowlist(self.settings) # resolve notification hosts in background from now on
+
+    def authorize(self, payment, form_data):
         self.log.debug('Authorize request: %s', form_data)
-        if not self.payment.transaction_id:
-            self.payment.transaction_id = self.settings['PREFIX'] + str(self.payment.id)
+        if not payment.transaction_id:
+            payment.transaction_id = self.settings['PREFIX'] + str(payment.id)
 
         if form_data['card_type'] not in PAYMENT_METHOD_CODES:
             raise errors.WorldpayError('Invalid payment method')
 
-        payment_node = self._acme('worldpay/authorize.xml', {
-                'form_data' : form_data,
-                'request'   : form_data.get('request'),
-                'payment_method'  : PAYMENT_METHOD_CODES[form_data['card_type']],
-                'shipping_address': self.payment.purchase.shipping_address,
-            }, './orderStatus/payment')
+        try:
+            payment_node = self._acme(payment, 'worldpay/authorize.xml', {
+                    'form_data' : form_data,
+                    'request'   : form_data.get('request'),
+                    'payment_method'  : PAYMENT_METHOD_CODES[form_data['card_type']],
+                    'shipping_address': payment.purchase.shipping_address,
+                }, ORDER_PAYMENT)
+        except errors.WorldpayNetworkError, e:
+            # order may have landed anyway: ask for it instead of submitting again
+            self.log.warning('Authorize request for %s failed (%s), checking order status', payment, e)
+            try:
+                payment_node = self._acme(payment, 'worldpay/get_status.xml', None, ORDER_PAYMENT)
+            except GatewayError: # including open circuit breaker
+                raise e
 
         result = self.parse_payment_node(payment_node)
 
         if True: #'reason' not in result:
             bursar_models.CreditCardDetail(
-                    payment= self.payment,
+                    payment= payment,
                     ccv    = form_data['cvc'],
                     card_no= form_data['card_no'],
                     expiry = form_data['expiry'],
@@ -109,16 +160,16 @@ class PaymentProcessor(base.BasePaymentProcessor):
         self.log.debug('Authorize result: %s', result)
         return result
 
-    def capture(self, form_data):
-        if not self.payment.transaction_id:
-            self.payment.transaction_id = self.settings['PREFIX'] + str(self.payment.id)
+    def capture(self, payment, form_data):
+        if not payment.transaction_id:
+            payment.transaction_id = self.settings['PREFIX'] + str(payment.id)
 
-        raise NotImplementedErorr
+        raise NotImplementedError
 
-    def capture_authorized(self, amount):
-        self.log.debug('Capture authorized request: %s, %s', self.payment, amount)
+    def capture_authorized(self, payment, amount):
+        self.log.debug('Capture authorized request: %s, %s', payment, amount)
 
-        amount_node = self._acme('worldpay/capture_authorized.xml', {'amount': amount}, './ok/captureReceived/amount')
+        amount_node = self._acme(payment, 'worldpay/capture_authorized.xml', {'amount': amount}, CAPTURE_AMOUNT)
         captured_amount = get_amount(amount_node)
         if captured_amount is None:
             raise errors.WorldpayError('Invalid amount node in response')
@@ -131,23 +182,23 @@ class PaymentProcessor(base.BasePaymentProcessor):
         self.log.debug('Capture authorized result: %s', result)
         return result
 
-    def release_authorized(self):
-        self.log.debug('Release authorized request: %s', self.payment)
-        self._acme('worldpay/release_authorized.xml', None, './ok/cancelReceived')
+    def release_authorized(self, payment):
+        self.log.debug('Release authorized request: %s', payment)
+        self._acme(payment, 'worldpay/release_authorized.xml', None, CANCEL_RECEIVED)
         return { 'status' : 'C' }
 
-    def refund(self, amount):
-        assert(amount <= self.payment.amount)
-        self.log.debug('Refund request: %s, %s', self.payment, amount)
+    def refund(self, payment, amount):
+        assert(amount <= payment.amount)
+        self.log.debug('Refund request: %s, %s', payment, amount)
 
-        amount_node = self._acme('worldpay/refund.xml', {'amount': amount }, './ok/refundReceived/amount')
+        amount_node = self._acme(payment, 'worldpay/refund.xml', {'amount': amount }, REFUND_AMOUNT)
 
         refunded_amount = get_amount(amount_node)
         if not refunded_amount:
             raise errors.WorldpayError('Missing refund amount node in modification response')
 
         result = {
-            'amount' : self.payment.amount - refunded_amount,
+            'amount' : payment.amount - refunded_amount,
         }
         if result['amount'] <= 0:
             result['status'] = 'RF'
@@ -155,19 +206,79 @@ class PaymentProcessor(base.BasePaymentProcessor):
         self.log.debug('Refund result: %s', result)
         return result
 
-    def get_payment_status(self):
-        self.log.debug('Get status request for payment: %s', self.payment)
-        payment_node = self._acme('worldpay/get_status.xml', None, './orderStatus/payment')
+    def capture_authorized_many(self, modifications):
+        results = {}
+        for payment, received in self._modify_many('capture', modifications):
+            captured_amount = get_amount(get_first(AMOUNT(received)))
+            if captured_amount is not None:
+                results[payment.id] = {'status': 'CD', 'amount': captured_amount}
+        return results
+
+    def release_authorized_many(self, payments):
+        return dict((payment.id, {'status': 'C'})
+                    for payment, received in self._modify_many('cancel', [(payment, None) for payment in payments]))
+
+    def refund_many(self, modifications):
+        results = {}
+        for payment, received in self._modify_many('refund', modifications):
+            refunded_amount = get_amount(get_first(AMOUNT(received)))
+            if refunded_amount:
+                result = results[payment.id] = {'amount': payment.amount - refunded_amount}
+                if result['amount'] <= 0:
+                    result['status'] = 'RF'
+        return results
+
+    def _modify_many(self, action, modifications):
+        """ Sends modifications in batches of up to MAX_BATCH_MODIFICATIONS orders
+            per request. Yields (payment, *Received node) for confirmed ones.
+            If Worldpay rejects a batch, its orders are sent one by one """
+        batch_size = self.settings['MAX_BATCH_MODIFICATIONS']
+        for start in range(0, len(modifications), batch_size):
+            batch = modifications[start:start+batch_size]
+            try:
+                confirmed = self._modify_batch(action, batch)
+            except errors.WorldpayNetworkError:
+                self.log.exception('Batch %s request failed', action)
+                continue
+            except errors.WorldpayError:
+                if len(batch) == 1:
+                    self.log.exception('Batch %s request failed', action)
+                    continue
+                self.log.warning('Batch %s request rejected, sending its %s orders one by one', action, len(batch))
+                confirmed = []
+                for modification in batch:
+                    try:
+                        confirmed.extend(self._modify_batch(action, [modification]))
+                    except errors.WorldpayError:
+                        self.log.exception('%s request failed', action)
+
+            for payment, received in confirmed:
+                yield payment, received
+
+    def _modify_batch(self, action, batch):
+        """ one modify request for [(payment, amount), ..], returns [(payment, *Received node), ..] """
+        payments = dict((payment.transaction_id or str(payment.id), payment) for payment, amount in batch)
+        self.log.debug('Batch %s request: %s', action, batch)
+        reply_node = self.request_by_template('worldpay/modify_batch.xml', None, {
+                'action'        : action,
+                'modifications' : [{'payment': payment, 'amount': amount} for payment, amount in batch],
+            })
+        return [(payments[received.attrib.get('orderCode')], received) for received in RECEIVED[action](reply_node)
+                if received.attrib.get('orderCode') in payments]
+
+    def get_payment_status(self, payment):
+        self.log.debug('Get status request for payment: %s', payment)
+        payment_node = self._acme(payment, 'worldpay/get_status.xml', None, ORDER_PAYMENT)
         return self.parse_payment_node(payment_node)
 
     def parse_payment_node(self, payment_node):
-        balance_node = get_first(payment_node.xpath('./balance'))
-        if balance_node:
-            amount_node = get_first(balance_node.xpath('./amount'))
+        balance_node = get_first(BALANCE(payment_node))
+        if balance_node is not None:
+            amount_node = get_first(AMOUNT(balance_node))
             status_code = balance_node.attrib.get('accountType')
         else:
-            amount_node = get_first(payment_node.xpath('./amount'))
-            status_code = get_first(payment_node.xpath('./lastEvent/text()'))
+            amount_node = get_first(AMOUNT(payment_node))
+            status_code = get_first(LAST_EVENT(payment_node))
 
         amount = get_amount(amount_node)
         if amount is None:
@@ -181,72 +292,124 @@ class PaymentProcessor(base.BasePaymentProcessor):
                 'status' : STATUSES[status_code],
             }
 
-        reason = get_first(payment_node.xpath('./ISO8583ReturnCode/@description'))
+        reason = get_first(RETURN_DESCRIPTION(payment_node))
         if reason:
             result['reason'] = reason
 
         return result
 
-    def _acme(self, template, vars, xpath):
-        reply_node = self.request_by_template(template, vars)
-
-        main_node = get_first(reply_node.xpath(xpath))
+    def iterparse_statuses(self, stream):
+        """ Parses (inquiry) reply from file-like stream with bounded memory:
+            every orderStatus node is dropped as soon as it is parsed.
+            Yields (orderCode, parse_payment_node() result or None if no payment node) """
+        for event, node in etree.iterparse(stream, events=('end',), tag=('orderStatus', 'error')):
+            parent = node.getparent()
+            if node.tag == 'error':
+                if parent is not None and parent.tag == 'reply':
+                    raise errors.WorldpayError('Errors in response', {int(node.attrib.get('code')): node.text})
+                continue
+
+            payment_node = get_first(STATUS_PAYMENT(node))
+            yield node.attrib.get('orderCode'), payment_node is not None and self.parse_payment_node(payment_node) or None
+
+            node.clear()
+            while node.getprevious() is not None:
+                del parent[0]
+
+    def send_inquiry(self, request_text):
+        """ send_post counterpart for large inquiry replies, parsed by iterparse_statuses.
+            Returns [(orderCode, result), ..] """
+        self.log.debug("About to send an inquiry to worldpay: %s\n%s", self.connection, request_text)
+        return self._post(request_text, lambda response: list(self.iterparse_statuses(response)), 'get_payment_status')
+
+    def _acme(self, payment, template, vars, xpath):
+        """ xpath is compiled etree.XPath """
+        reply_node = self.request_by_template(template, payment, vars)
+
+        main_node = get_first(xpath(reply_node))
         if main_node is None:
-            raise errors.WorldpayError('Missing %s node in response'%xpath)
+            raise errors.WorldpayError('Missing %s node in response'%xpath.path)
 
         return main_node
 
-    def request_by_template(self, template, variables=None):
-        """ creates a request basing on template and data passed """
+    def request_by_template(self, template, payment, variables=None):
+        """ creates a request basing on template and data passed, returns parsed response """
+        request_text = self.build_request(template, payment, variables)
+        metrics.mark('build')
+        return self.send_post(request_text, TEMPLATE_OPERATIONS.get(template))
+
+    def build_request(self, template, payment, variables=None):
+        """ request text for template and data passed """
         template_vars = {
-                'payment'  : self.payment,
+                'payment'  : payment,
                 'currency' : self.settings['CURRENCY'],
                 'MERCHANT_ID' : self.settings['MERCHANT_ID'],
             }
         if variables:
             template_vars.update(variables)
-        request_text = template_loader.render_to_string(template, template_vars)
-
-        return self.send_post(request_text)
-
-    def send_post(self, request_text):
-        """ Helper method to make POST request and return parsed response """
-        self.log.debug("About to send a request to worldpay: %(connection)s\n%(content)s"%{'connection':self.connection, 'content':request_text})
-
-        headers = {
-                "Authorization" : "Basic %s"%base64.b64encode(":".join([self.settings['MERCHANT_ID'], self.settings['XML_PASSWORD']])),
-                "Content-Type": "text/xml; charset=utf-8",
-            }
-        request = urllib2.Request(self.connection, request_text, headers)
-
-        rqrs = models.RequestResponse(
-                request = request_text.encode('utf8'),
-                https   = bursar_settings.LIVE,
-            )
-
-        result = urllib2.urlopen(request)
-
-        response_text = result.read()
-        self.log.debug('Worldpay response: %s', response_text)
-
-        try:
-            XML = etree.fromstring(response_text)
-        except:
-            rqrs.response= response_text
-            raise
+        if template in self.builders:
+            return self.builders[template](template_vars)
+        return template_loader.render_to_string(template, template_vars)
+
+    def send_post(self, request_text, operation=None):
+        """ Helper method to make POST request and return parsed response.
+            operation (see TEMPLATE_OPERATIONS) selects timeouts and retries """
+        self.log.debug("About to send a request to worldpay: %s\n%s", self.connection, request_text)
+
+        capture_rqrs = self.capture_pipeline.sampled()
+        if capture_rqrs or self.log.isEnabledFor(logging.DEBUG):
+            response_text = None
+            try:
+                response_text = self._post(request_text, operation=operation)
+                metrics.mark('network')
+                self.log.debug('Worldpay response: %s', response_text)
+                XML = etree.fromstring(response_text)
+            finally:
+                if capture_rqrs:
+                    # redacted and written by background thread, see capture.py
+                    self.capture_pipeline.put(request_text, response_text)
         else:
-            rqrs.response= etree.tostring(XML, pretty_print=True)
-        finally:
-            if not bursar_settings.LIVE:
-                rqrs.save()
+            # nothing to log: feed response stream straight into parser,
+            # so 'network' phase ends with response headers and body is read while parsing
+            XML = self._post(request_text, self._parse_response, operation)
 
-        reply_node = get_first(XML.xpath('/paymentService/reply'))
+        reply_node = get_first(REPLY(XML))
         if reply_node is not None:
             errs = dict((int(node.attrib.get('code')), node.text)
-                            for node in reply_node.xpath('./error'))
+                            for node in REPLY_ERRORS(reply_node))
             if errs:
                 raise errors.WorldpayError('Errors in response', errs)
         else:
             raise errors.WorldpayError('Invalid request')
 
+        metrics.mark('parse')
         return reply_node
+
+    def _post(self, request_text, handler=None, operation=None):
+        """ pool.post with operation timeouts, behind the circuit breaker.
+            Idempotent operations are retried with jittered exponential backoff """
+        connect_timeout, read_timeout = self.settings.get('TIMEOUTS', {}).get(operation, (None, None))
+        attempts = 1 + (self.settings.get('RETRIES', 0) if operation in IDEMPOTENT else 0)
+        for attempt in range(attempts):
+            self.breaker.before()
+            try:
+                result = self.pool.post(request_text, handler, connect_timeout, read_timeout,
+                                        idempotent=operation in IDEMPOTENT)
+            except NETWORK_ERRORS, e:
+                self.breaker.failure()
+                if attempt + 1 < attempts:
+                    self.log.warning('%s request failed (%s), retrying', operation, e)
+                    time.sleep(random.uniform(0, self.settings.get('RETRY_BACKOFF', 0.2) * 2 ** attempt))
+                    continue
+                if isinstance(e, errors.WorldpayNetworkError):
+                    raise
+                raise errors.WorldpayNetworkError('%s: %s' % (e.__class__.__name__, e))
+            except:
+                self.breaker.success() # gateway did answer, eg with malformed document
+                raise
+            self.breaker.success()
+            return result
+
+    def _parse_response(self, response):
+        metrics.mark('network')
+        return etree.parse(response).getroot()
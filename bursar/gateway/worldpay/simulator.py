@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for Worldpay XML paymentService, for offline load testing:
+
+    python -m bursar.gateway.worldpay.simulator --port 8800 --latency 80 --jitter 30 --error-rate 0.01
+
+and point the processor at it:
+
+    BURSAR_SETTINGS = {'WORLDPAY': {'TEST_SERVICE_URL': 'http://127.0.0.1:8800/', ...}}
+
+Orders are kept in memory. Authorizations honor Worldpay test values:
+cardholder names REFUSED, REFERRED, FRAUD and ERROR, and CVC 111..555 (see
+CVC_RESULTS). Captures, cancels and refunds, single or batched, change the
+order book, and inquiries report the current order status.
+"""
+import sys
+import time
+import random
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from lxml import etree
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+         '<!DOCTYPE paymentService PUBLIC "-//WorldPay//DTD WorldPay PaymentService v1//EN" ' \
+         '"http://dtd.worldpay.com/paymentService_v1.dtd">\n'
+
+CVC_RESULTS = {
+    ''   : 'NOT SUPPLIED BY SHOPPER',
+    '111': 'NOT SENT TO ACQUIRER',
+    '222': 'NO RESPONSE FROM ACQUIRER',
+    '333': 'NOT CHECKED BY ACQUIRER',
+    '444': 'FAILED',
+    '555': 'APPROVED',
+}
+
+# cardholder name => (lastEvent, ISO8583 return code, description)
+CARDHOLDER_RESULTS = {
+    'REFUSED' : ('REFUSED', '5', 'REFUSED'),
+    'REFERRED': ('REFUSED', '2', 'REFERRED'),
+    'FRAUD'   : ('REFUSED', '34', 'FRAUD SUSPICION'),
+    'ERROR'   : ('ERROR', None, None),
+}
+
+# order state => balance accountType
+ACCOUNT_TYPES = {
+    'AUTHORISED': 'IN_PROCESS_AUTHORISED',
+    'CAPTURED'  : 'IN_PROCESS_CAPTURED',
+}
+
+class SimulatorError(Exception):
+    """ reply level <error code=..> """
+    def __init__(self, code, message):
+        super(SimulatorError, self).__init__(message)
+        self.code = code
+
+class OrderBook(object):
+    """ In-memory orders: orderCode => dict """
+    def __init__(self):
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def handle(self, root):
+        """ paymentService request document => reply element """
+        reply = etree.Element('reply')
+        for command in root:
+            if command.tag == 'submit':
+                for order in command.iter('order'):
+                    reply.append(self.submit(order))
+            elif command.tag == 'modify':
+                modifications = command.findall('orderModification')
+                ok = etree.SubElement(reply, 'ok')
+                for modification in modifications:
+                    try:
+                        ok.append(self.modify(modification))
+                    except SimulatorError:
+                        if len(modifications) == 1:
+                            raise
+                        # batch: failed modifications are just not confirmed
+            elif command.tag == 'inquiry':
+                for inquiry in command.iter('orderInquiry'):
+                    reply.append(self.status(inquiry.get('orderCode')))
+            else:
+                raise SimulatorError('2', 'Unknown command %s' % command.tag)
+        return reply
+
+    def submit(self, order_node):
+        order_code = order_node.get('orderCode')
+        amount = order_node.find('amount')
+        details = order_node.find('paymentDetails')
+        if not order_code or amount is None or details is None or not len(details):
+            raise SimulatorError('2', 'Invalid order')
+        method = details[0]
+        cardholder = (method.findtext('cardHolderName') or '').strip().upper()
+        card_number = (method.findtext('cardNumber') or '').strip()
+
+        last_event, return_code, description = CARDHOLDER_RESULTS.get(cardholder, ('AUTHORISED', None, None))
+        order = {
+            'method'     : method.tag,
+            'value'      : int(amount.get('value')),
+            'currency'   : amount.get('currencyCode'),
+            'exponent'   : amount.get('exponent', '2'),
+            'balance'    : int(amount.get('value')),
+            'status'     : last_event,
+            'cvc_result' : CVC_RESULTS.get((method.findtext('cvc') or '').strip(), 'APPROVED'),
+            'return_code': return_code and (return_code, description),
+            'card_number': card_number[:4] + '*' * max(len(card_number) - 8, 0) + card_number[-4:],
+        }
+        with self.lock:
+            if order_code in self.orders:
+                raise SimulatorError('5', 'Duplicate Order')
+            self.orders[order_code] = order
+        return self.status(order_code)
+
+    def modify(self, modification):
+        order_code = modification.get('orderCode')
+        if not len(modification):
+            raise SimulatorError('2', 'Empty modification')
+        action = modification[0]
+        with self.lock:
+            order = self.orders.get(order_code)
+            if order is None:
+                raise SimulatorError('5', 'Could not find payment for order')
+            amount = action.find('amount')
+            value = int(amount.get('value')) if amount is not None else None
+
+            if action.tag == 'capture' and order['status'] == 'AUTHORISED':
+                value = order['balance'] if value is None else value
+                if value > order['balance']:
+                    raise SimulatorError('5', 'Capture amount exceeds authorised amount')
+                order['status'], order['balance'] = 'CAPTURED', value
+            elif action.tag == 'cancel' and order['status'] == 'AUTHORISED':
+                order['status'] = 'CANCELLED'
+            elif action.tag == 'refund' and order['status'] in ('CAPTURED', 'SETTLED'):
+                value = order['balance'] if value is None else value
+                if value > order['balance']:
+                    raise SimulatorError('5', 'Refund amount exceeds captured amount')
+                order['balance'] -= value
+                if not order['balance']:
+                    order['status'] = 'SENT_FOR_REFUND'
+            else:
+                raise SimulatorError('5', 'Order can not be modified by %s in status %s' % (action.tag, order['status']))
+
+            received = etree.Element(action.tag + 'Received', orderCode=order_code)
+            if value is not None:
+                self.amount(received, order, value)
+        return received
+
+    def amount(self, parent, order, value):
+        return etree.SubElement(parent, 'amount', value=str(value), currencyCode=order['currency'],
+                                exponent=order['exponent'], debitCreditIndicator='credit')
+
+    def status(self, order_code):
+        with self.lock:
+            order = self.orders.get(order_code)
+            if order is None:
+                raise SimulatorError('5', 'Could not find payment for order')
+            order = dict(order)
+
+        order_status = etree.Element('orderStatus', orderCode=order_code)
+        payment = etree.SubElement(order_status, 'payment')
+        etree.SubElement(payment, 'paymentMethod').text = order['method']
+        self.amount(payment, order, order['balance'] if order['status'] != 'SENT_FOR_REFUND' else order['value'])
+        etree.SubElement(payment, 'lastEvent').text = order['status']
+        etree.SubElement(payment, 'CVCResultCode', description=order['cvc_result'])
+        if order['return_code']:
+            etree.SubElement(payment, 'ISO8583ReturnCode', code=order['return_code'][0],
+                             description=order['return_code'][1])
+        if order['status'] in ACCOUNT_TYPES:
+            balance = etree.SubElement(payment, 'balance', accountType=ACCOUNT_TYPES[order['status']])
+            self.amount(balance, order, order['balance'])
+        etree.SubElement(payment, 'cardNumber').text = order['card_number']
+        return order_status
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as pool.ConnectionPool expects
+    wbufsize = -1                 # send headers and body together ..
+    disable_nagle_algorithm = True # .. without waiting for delayed ACKs
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.delay()
+
+        merchant_code = ''
+        try:
+            if random.random() < self.server.error_rate:
+                raise SimulatorError('1', 'Internal error')
+            try:
+                root = etree.fromstring(body)
+            except etree.XMLSyntaxError, e:
+                raise SimulatorError('2', 'Invalid XML: %s' % e)
+            merchant_code = root.get('merchantCode', '')
+            reply = self.server.orders.handle(root)
+        except SimulatorError, e:
+            reply = etree.Element('reply')
+            etree.SubElement(reply, 'error', code=e.code).text = etree.CDATA(unicode(e))
+
+        service = etree.Element('paymentService', version='1.4', merchantCode=merchant_code)
+        service.append(reply)
+        response = HEADER + etree.tostring(service)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class Simulator(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ latency and jitter are milliseconds: every reply is delayed by
+        max(0, gauss(latency, jitter)). error_rate is 0..1 share of requests
+        answered with Worldpay internal error """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0, error_rate=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.orders = OrderBook()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address[:2]
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(max(0, random.gauss(self.latency, self.jitter)) / 1000.0)
+
+    def start(self):
+        """ serve in a background thread, eg in tests. Returns the thread """
+        thread = threading.Thread(target=self.serve_forever, name='worldpay-simulator')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8800)
+    parser.add_option('--latency', type='float', default=0, help='mean reply delay, ms [%default]')
+    parser.add_option('--jitter', type='float', default=0, help='standard deviation of reply delay, ms [%default]')
+    parser.add_option('--error-rate', type='float', default=0, dest='error_rate',
+                      help='share of requests failing with internal error, 0..1 [%default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False, help='log requests')
+    options, args = parser.parse_args(argv)
+
+    simulator = Simulator((options.host, options.port), options.latency, options.jitter,
+                          options.error_rate, options.verbose)
+    sys.stderr.write('Worldpay simulator listening on %s\n' % simulator.url)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 from django import template
 
+from bursar import utils
+
 register = template.Library()
 
 @register.filter
 def amount(value):
-    return int(value*100)
+    """ amount => integer minor units, exponent 2 """
+    return utils.to_minor_units(value)
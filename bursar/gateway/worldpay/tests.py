@@ -1,9 +1,24 @@
 # -*- coding: UTF-8 -*-
-import datetime
+import time
+import socket
+import httplib
+import threading
+import unittest
+import cStringIO as StringIO
+from decimal import Decimal
 
+from lxml import etree
+from django.template import loader as template_loader
+
+from bursar import errors as bursar_errors
+from bursar import models as bursar_models
+from bursar import settings as bursar_settings
+from bursar import utils
 from bursar.tests import make_test_purchase
+from bursar.gateway import breaker
 
-from . import processor
+from . import processor, builder, capture, notifications, pool, simulator, errors
+from .fixtures import default_request, default_form_data, test_payment
 
 """
 CVC2 for test scenarios
@@ -49,29 +64,6 @@ status_update?OrderCode=DEMO_ORDER123456789&PaymentId=15390&PaymentStatus=AUTHOR
 
 """
 
-class default_request:
-    class META:
-        REMOTE_ADDR = '194.61.183.122'
-        HTTP_ACCEPT = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
-        HTTP_USER_AGENT = 'Mozilla/5.0 (X11; Linux i686; rv:7.0.1) Gecko/20100101 Firefox/7.0.1'
-    class session:
-        session_key = '0938209340293842938492348209348'
-
-default_form_data = {
-        'name'    : 'John Smith',
-        'address' : 'Baker st, 221b',
-        'city'    : 'London',
-        'zip'     : 'NW1',
-        'country' : 'GB',
-        'phone'   : '7935-8866',
-        'email'   : 'testuser@test.com',
-        'card_no' : '4444333322221111',
-        'card_type' : 'VISA',
-        'expiry'  : datetime.date.today() + datetime.timedelta(days=400),
-        'cvc'     : '123',
-        'request' : default_request,
-    }
-
 class TestGateway(unittest.TestCase):
     def tearUP(self):
         bursar_settings.LIVE = False
@@ -79,3 +71,269 @@ class TestGateway(unittest.TestCase):
     def test_form(self):
         form_data = default_form_data
 
+class TestRequestBuilder(unittest.TestCase):
+    def test_equivalence(self):
+        """ lxml builders produce the same documents as templates """
+        template_vars = {
+            'payment'   : test_payment(),
+            'currency'  : 'GBP',
+            'MERCHANT_ID': 'MERCHANT',
+            'amount'    : 5.25,
+            'form_data' : default_form_data,
+            'request'   : default_request,
+            'payment_method': processor.PAYMENT_METHOD_CODES['VISA'],
+            'modifications' : [{'payment': test_payment(), 'amount': 5.25}, {'payment': test_payment(), 'amount': 1}],
+        }
+        for action in ('capture', 'cancel'):
+            template_vars['action'] = action
+            for template, build in builder.BUILDERS.items():
+                self.assertEqual(builder.normalize(template_loader.render_to_string(template, template_vars)),
+                                 builder.normalize(build(template_vars)), template)
+
+    def test_amounts(self):
+        """ amounts go to and from minor units without float rounding """
+        document = etree.fromstring(builder.capture_authorized({'payment': test_payment(), 'currency': 'GBP',
+                                                                'MERCHANT_ID': 'MERCHANT', 'amount': 0.29}))
+        amount_node = document.find('.//amount')
+        self.assertEqual(amount_node.get('value'), '29')
+        self.assertEqual(processor.get_amount(amount_node), Decimal('0.29'))
+
+class TestCapture(unittest.TestCase):
+    def test_redact(self):
+        request_text = builder.authorize({
+            'payment'   : test_payment(),
+            'currency'  : 'GBP',
+            'MERCHANT_ID': 'MERCHANT',
+            'form_data' : default_form_data,
+            'request'   : default_request,
+            'payment_method': processor.PAYMENT_METHOD_CODES['VISA'],
+        })
+        redacted = capture.redact(request_text)
+        self.assertNotIn(default_form_data['card_no'], redacted)
+        self.assertNotIn('<cvc>%s</cvc>' % default_form_data['cvc'], redacted)
+        self.assertIn('<cardNumber>************1111</cardNumber>', redacted)
+
+class TestNotifications(unittest.TestCase):
+    def test_allowlist(self):
+        allowlist = notifications.Allowlist(networks=('195.35.90.0/23', '10.0.0.1'))
+        self.assertIn('195.35.91.17', allowlist)
+        self.assertIn('10.0.0.1', allowlist)
+        self.assertNotIn('195.35.92.1', allowlist)
+        self.assertNotIn('10.0.0.2', allowlist)
+        self.assertNotIn(None, allowlist)
+        # hosts are resolved in background, checks don't wait for them
+        allowlist = notifications.Allowlist(hosts=('localhost',), refresh=3600)
+        self.assertNotIn('127.0.0.1', allowlist)
+        allowlist.start()
+        for attempt in range(50):
+            if '127.0.0.1' in allowlist:
+                break
+            time.sleep(0.1)
+        self.assertIn('127.0.0.1', allowlist)
+
+    def test_apply(self):
+        purchase = make_test_purchase(10)
+        payment = bursar_models.Payment.objects.create(method='worldpay', purchase=purchase, amount=10, status='A')
+        self.assertTrue(notifications.apply(payment.id, 'CAPTURED', 10.0))
+        self.assertEqual(bursar_models.Payment.objects.get(pk=payment.id).status, 'CD')
+        # CD can not go back to A, repeated or late notification is no-op
+        self.assertFalse(notifications.apply(payment.id, 'AUTHORISED', 10.0))
+        self.assertFalse(notifications.apply(payment.id, 'CAPTURED', 10.0))
+        self.assertEqual(bursar_models.Payment.objects.get(pk=payment.id).status, 'CD')
+        self.assertEqual(payment.notes.count(), 1)
+        # same status, new amount: partially refunded
+        self.assertTrue(notifications.apply(payment.id, 'SENT_FOR_REFUND', 10.0))
+        self.assertTrue(notifications.apply(payment.id, 'SENT_FOR_REFUND', 4.0))
+        self.assertFalse(notifications.apply(payment.id, 'SENT_FOR_REFUND', 4.0))
+        self.assertFalse(notifications.apply(payment.id, 'CAPTURED', 10.0)) # late, refunded payments don't go back
+        self.assertFalse(notifications.apply(payment.id, 'CANCELLED', 10.0))
+        self.assertEqual(bursar_models.Payment.objects.get(pk=payment.id).amount, Decimal('4.00'))
+        self.assertEqual(payment.notes.count(), 3)
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        self.simulator = simulator.Simulator()
+        self.simulator.start()
+        self.gateway = processor.PaymentProcessor()
+        self.gateway.pool = pool.ConnectionPool(self.simulator.url, 'MERCHANT', 'password')
+        self.gateway.builders = builder.BUILDERS
+        self.gateway.capture_pipeline = capture.CapturePipeline()
+        self.gateway.capture_pipeline.sampled = lambda: False
+
+    def tearDown(self):
+        self.gateway.pool.close()
+        self.simulator.shutdown()
+        self.simulator.server_close()
+
+    def authorize(self, payment, **form_data):
+        reply = self.gateway.send_post(builder.authorize({
+            'payment'   : payment,
+            'currency'  : 'GBP',
+            'MERCHANT_ID': 'MERCHANT',
+            'form_data' : dict(default_form_data, **form_data),
+            'request'   : default_request,
+            'payment_method': processor.PAYMENT_METHOD_CODES['VISA'],
+        }))
+        return self.gateway.parse_payment_node(processor.ORDER_PAYMENT(reply)[0])
+
+    def test_lifecycle(self):
+        payment = test_payment()
+        self.assertEqual(self.authorize(payment), {'status': 'A', 'amount': 10.5})
+        self.assertEqual(self.gateway.capture_authorized(payment, 6), {'status': 'CD', 'amount': 6})
+        payment.amount = 6
+        self.assertEqual(self.gateway.refund(payment, 2), {'amount': 4})
+        self.assertEqual(self.gateway.get_payment_status(payment), {'status': 'CD', 'amount': 4})
+        self.assertRaises(errors.WorldpayError, self.gateway.release_authorized, payment)
+
+    def test_rejected_batch(self):
+        """ orders of a batch Worldpay rejects are modified one by one """
+        payments = []
+        for payment_id in (21, 22, 23):
+            payment = test_payment()
+            payment.id, payment.transaction_id = payment_id, 'batch%s' % payment_id
+            self.authorize(payment)
+            payments.append(payment)
+
+        handle, requests = self.simulator.orders.handle, []
+        def single_modifications(root):
+            requests.append(len(root.findall('modify/orderModification')))
+            if requests[-1] > 1:
+                raise simulator.SimulatorError('5', 'Only one orderModification allowed')
+            return handle(root)
+        self.simulator.orders.handle = single_modifications
+        self.gateway.settings = dict(self.gateway.settings, MAX_BATCH_MODIFICATIONS=2)
+
+        results = self.gateway.capture_authorized_many([(payment, 5) for payment in payments])
+        self.assertEqual(results, {21: {'status': 'CD', 'amount': 5}, 22: {'status': 'CD', 'amount': 5},
+                                   23: {'status': 'CD', 'amount': 5}})
+        self.assertEqual(requests, [2, 1, 1, 1])
+
+    def test_capture_operation(self):
+        """ capture is the gateway operation, request/response capture is capture_pipeline """
+        gateway = utils.get_processor_instance(processor.PROCESSOR_KEY.lower())
+        self.assertIsInstance(gateway.capture_pipeline, capture.CapturePipeline)
+        self.assertTrue(getattr(gateway.capture, 'instrumented', False))
+        payment = test_payment()
+        self.assertRaises(NotImplementedError, gateway.capture, payment, default_form_data)
+        self.assertEqual(payment.transaction_id, gateway.settings['PREFIX'] + str(payment.id))
+
+    def test_inquiry(self):
+        payment = test_payment()
+        self.authorize(payment)
+        self.assertEqual(self.gateway.send_inquiry(self.gateway.build_request('worldpay/get_status.xml', payment)),
+                         [(builder.order_code(payment), {'status': 'A', 'amount': 10.5})])
+
+        reply = '''<?xml version="1.0" encoding="UTF-8"?>
+<paymentService version="1.4" merchantCode="MERCHANT"><reply>
+    <orderStatus orderCode="15"><payment>
+        <paymentMethod>VISA-SSL</paymentMethod>
+        <amount value="1050" currencyCode="GBP" exponent="2" debitCreditIndicator="credit"/>
+        <lastEvent>AUTHORISED</lastEvent>
+    </payment></orderStatus>
+    <orderStatus orderCode="16"><error code="5"><![CDATA[Could not find payment for order]]></error></orderStatus>
+</reply></paymentService>'''
+        self.assertEqual(list(self.gateway.iterparse_statuses(StringIO.StringIO(reply))),
+                         [('15', {'status': 'A', 'amount': 10.5}), ('16', None)]) # order error: no status
+        reply = '''<?xml version="1.0" encoding="UTF-8"?>
+<paymentService version="1.4" merchantCode="MERCHANT"><reply>
+    <error code="4"><![CDATA[Security violation]]></error>
+</reply></paymentService>'''
+        self.assertRaises(errors.WorldpayError, list, self.gateway.iterparse_statuses(StringIO.StringIO(reply)))
+
+    def test_magic_values(self):
+        payment = test_payment()
+        payment.transaction_id = 'refused'
+        self.assertEqual(self.authorize(payment, name='REFUSED'), {'status': 'R', 'amount': 10.5, 'reason': 'REFUSED'})
+        self.assertRaises(errors.WorldpayError, self.authorize, payment) # duplicate order
+
+class TestResilience(unittest.TestCase):
+    def test_retries_and_breaker(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%s/' % listener.getsockname()[1]
+        listener.close() # nothing listens there: connections are refused
+
+        gateway = processor.PaymentProcessor()
+        gateway.pool = pool.ConnectionPool(url, 'MERCHANT', 'password')
+        gateway.breaker = breaker.CircuitBreaker('test', min_requests=3, reset_timeout=60)
+        gateway.settings = dict(gateway.settings, RETRIES=2, RETRY_BACKOFF=0)
+        gateway.capture_pipeline = capture.CapturePipeline()
+        gateway.capture_pipeline.sampled = lambda: False
+
+        self.assertRaises(errors.WorldpayNetworkError, gateway.get_payment_status, test_payment())
+        self.assertEqual(list(gateway.breaker.outcomes), [True, True, True]) # request and 2 retries
+        self.assertEqual(gateway.breaker.state, breaker.OPEN)
+        try:
+            gateway.get_payment_status(test_payment())
+        except errors.WorldpayNetworkError:
+            self.fail('Open breaker should fail fast')
+        except bursar_errors.GatewayError:
+            pass
+        self.assertEqual(len(gateway.breaker.outcomes), 3)
+
+        gateway.breaker.opened_at -= 60 # half-open: one trial request
+        self.assertRaises(errors.WorldpayNetworkError, gateway.release_authorized, test_payment())
+        self.assertEqual(gateway.breaker.state, breaker.OPEN)
+
+        # failed authorization opens the breaker, order status inquiry fails fast:
+        # the authorization error is reported, not the breaker one
+        gateway.breaker = breaker.CircuitBreaker('test', min_requests=1, reset_timeout=60)
+        self.assertRaises(errors.WorldpayNetworkError, gateway.authorize, test_payment(), default_form_data)
+        self.assertEqual(gateway.breaker.state, breaker.OPEN)
+
+    def test_pool_wait(self):
+        """ requests wait for a free connection up to their connect timeout """
+        connections = pool.ConnectionPool('http://127.0.0.1:1/', 'MERCHANT', 'password', size=1)
+        connections._acquire_slot(1) # a request in flight
+        started = time.time()
+        self.assertRaises(errors.WorldpayNetworkError, connections.post, 'submit', connect_timeout=0.2)
+        self.assertTrue(0.2 <= time.time() - started < 1)
+
+        threading.Timer(0.1, connections._release_slot).start()
+        connections._acquire_slot(1) # released while waiting
+
+    def test_dropped_connections(self):
+        """ a request is sent again on a fresh connection only if it can not
+            have been processed: not sent yet, or idempotent """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        received = []
+        replies = ['ok', 'drop', 'ok', 'drop', 'close', 'ok']
+        closed = threading.Semaphore(0)
+
+        def serve():
+            while len(received) < len(replies):
+                connection = listener.accept()[0]
+                stream = connection.makefile('rb')
+                while len(received) < len(replies):
+                    headers = []
+                    while not headers or headers[-1] != '\r\n':
+                        headers.append(stream.readline())
+                    length = [int(line.split(':')[1]) for line in headers if line.lower().startswith('content-length')][0]
+                    received.append(stream.read(length))
+                    if replies[len(received) - 1] == 'drop':
+                        break # processed, but the response is lost
+                    connection.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                    if replies[len(received) - 1] == 'close':
+                        break # keep-alive connection closed while idle
+                stream.close()
+                connection.close()
+                closed.release()
+        server = threading.Thread(target=serve)
+        server.daemon = True
+        server.start()
+
+        connections = pool.ConnectionPool('http://127.0.0.1:%s/' % listener.getsockname()[1], 'MERCHANT', 'password')
+        self.assertEqual(connections.post('submit'), 'ok')
+        self.assertRaises((socket.error, httplib.BadStatusLine), connections.post, 'modify') # reused connection, sent: not again
+        self.assertEqual(received, ['submit', 'modify'])
+        self.assertEqual(connections.post('submit'), 'ok')
+        self.assertEqual(connections.post('inquiry', idempotent=True), 'ok') # dropped, sent again
+        self.assertEqual(received, ['submit', 'modify', 'submit', 'inquiry', 'inquiry'])
+        for connection in range(3):
+            closed.acquire() # wait for the server to close the idle one
+        self.assertEqual(connections.post('submit'), 'ok') # closed idle connection is not reused
+        self.assertEqual(received[-1], 'submit')
+        server.join(5)
+        listener.close()
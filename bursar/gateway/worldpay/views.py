@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
+import logging
 from django.conf import settings
 
-from bursar import models as bursar_models
 from bursar import settings as bursar_settings
+from bursar import utils
 
-from . import models, processor
+from . import models, processor, notifications
 
 from lxml import etree
 
@@ -14,37 +15,34 @@ from django.contrib.auth.decorators import user_passes_test
 #used by download archive
 import zipfile, cStringIO as StringIO
 
-#used by status_update for DNS lookup
-import socket
-
-worldpay_address = None
+log = logging.getLogger('bursar.gateway.worldpay.views')
 
 def status_update(request):
     """ Callback view to update payment status.
-        It is highly recommended to set up its url in http(s) merchant channel """
-    # make sure reverse DNS matches worldpay.com
-    def get_worldpay_address():
-        global worldpay_address
-        if worldpay_address is None:
-            host_info = socket.getaddrinfo("rbsworldpay.com", 80, 0, 0, socket.SOL_TCP)
-            worldpay_address = host_info[0][4][0]
-        return worldpay_address
-
-    if bursar_settings.LIVE and request.META.REMOTE_ADDR != get_worldpay_address():
+        It is highly recommended to set up its url in http(s) merchant channel.
+        Source address is checked against precomputed allowlist, repeated
+        notifications are dropped and status is applied with a single UPDATE """
+    gateway_settings = utils.get_processor_instance(processor.PROCESSOR_KEY.lower()).settings
+    if bursar_settings.LIVE and request.META.get('REMOTE_ADDR') not in notifications.get_allowlist(gateway_settings):
         return http.HttpResponse(status=403)
 
     try:
-        payment = shortcuts.get_object_or_404(bursar_models.Payment, pk=request.REQUEST['PaymentId'])
+        payment_id  = int(request.REQUEST['PaymentId'])
         status_code = request.REQUEST['PaymentStatus']
-        result = {
-                'amount' : float(request.REQUEST['PaymentAmount'])/100,
-            }
-        if status_code in processor.STATUSES:
-            result['status'] = processor.STATUSES[status_code]
+        amount      = utils.from_minor_units(request.REQUEST['PaymentAmount'])
+    except (KeyError, ValueError):
+        log.warning('Invalid status notification: %s', request.REQUEST)
+        return http.HttpResponse('[OK]') # no point to send it again
+
+    if notifications.is_duplicate(payment_id, status_code, amount, gateway_settings.get('NOTIFICATION_DEDUP_TIMEOUT', 86400)):
+        return http.HttpResponse('[OK]')
 
-        payment._update(result)
+    try:
+        notifications.apply(payment_id, status_code, amount)
     except:
-        pass
+        # let Worldpay retry it later
+        notifications.forget(payment_id, status_code, amount)
+        raise
 
     return http.HttpResponse('[OK]')
 
@@ -53,8 +51,11 @@ def status_update(request):
 def debug(request, id=''):
     assert(not bursar_settings.LIVE)
     if request.method == 'POST':
-        p = processor.PaymentProcessor(None)
-        p.send_post(request.POST['request'])
+        gateway = utils.get_processor_instance(processor.PROCESSOR_KEY.lower())
+        try:
+            gateway.send_post(request.POST['request'])
+        finally:
+            gateway.capture_pipeline.flush() # make sure it is written before redirect
         id = ''
 
     if not id:
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Background bulk operations on payments, eg admin actions on thousands of them.
+A job runs operation(queryset) on chunks of payment ids on the concurrency
+executor; progress is kept in cache, so with a shared cache backend any web
+process can report it. Without "futures" package jobs run right away.
+"""
+import uuid
+import logging
+
+from django.core.cache import cache
+from django.db import connection
+
+from bursar import concurrency, models
+
+log = logging.getLogger('bursar.jobs')
+
+CHUNK_SIZE = 100
+PROGRESS_TIMEOUT = 86400
+
+def _key(job_id):
+    return 'bursar.job:%s' % job_id
+
+def start(name, operation, ids, chunk_size=CHUNK_SIZE):
+    """ Starts operation(queryset of payments) -> number of changed payments
+        on chunks of payment ids. Returns job id, see progress() """
+    job_id = uuid.uuid4().hex
+    ids = list(ids)
+    state = {
+        'name'    : name,
+        'total'   : len(ids),
+        'done'    : 0,
+        'changed' : 0,
+        'error'   : None,
+        'finished': False,
+    }
+    cache.set(_key(job_id), state, PROGRESS_TIMEOUT)
+
+    if concurrency.futures is None:
+        _run(job_id, state, operation, ids, chunk_size)
+    else:
+        concurrency.submit(_run, job_id, state, operation, ids, chunk_size, close_connection=True)
+    return job_id
+
+def progress(job_id):
+    """ {'name', 'total', 'done', 'changed', 'error', 'finished'} or None for unknown job """
+    return cache.get(_key(job_id))
+
+def _run(job_id, state, operation, ids, chunk_size, close_connection=False):
+    try:
+        for offset in range(0, len(ids), chunk_size):
+            chunk = ids[offset:offset+chunk_size]
+            state['changed'] += operation(models.Payment.objects.filter(id__in=chunk))
+            state['done'] += len(chunk)
+            cache.set(_key(job_id), state, PROGRESS_TIMEOUT)
+    except Exception, e:
+        log.exception('Job %s (%s) failed', job_id, state['name'])
+        state['error'] = unicode(e)
+    finally:
+        state['finished'] = True
+        cache.set(_key(job_id), state, PROGRESS_TIMEOUT)
+        if close_connection:
+            connection.close() # executor thread would keep it open otherwise
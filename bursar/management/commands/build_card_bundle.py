@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bursar import cardbundle
+
+class Command(BaseCommand):
+    help = "Builds client side card detection script and JSON from card types and gateway CREDITCHOICES"
+    option_list = BaseCommand.option_list + (
+        make_option('--output', default=cardbundle.DEFAULT_OUTPUT,
+                    help='directory to write to [bursar static files]'),
+    )
+
+    def handle(self, **options):
+        paths = cardbundle.write(options['output'])
+        if int(options['verbosity']):
+            for path in paths:
+                self.stdout.write('Written %s' % path)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from bursar import bins
+from bursar import settings as bursar_settings
+
+class Command(BaseCommand):
+    args = '<ranges.csv> [database file]'
+    help = "Compiles BIN ranges CSV (start,end,issuer,country,funding,card_type) into BIN_DATABASE file " \
+           "or the given one. Running servers pick it up without restart"
+
+    def handle(self, *args, **options):
+        if not 1 <= len(args) <= 2:
+            raise CommandError('Usage: compile_bins %s' % self.args)
+        path = args[1] if len(args) > 1 else bursar_settings.working_settings.get('BIN_DATABASE')
+        if not path:
+            raise CommandError('Give database file or set BIN_DATABASE in BURSAR_SETTINGS')
+
+        try:
+            with open(args[0], 'rb') as csv_file:
+                count = bins.compile_csv(csv_file, path)
+        except (IOError, ValueError), e:
+            raise CommandError('Can not compile %s: %s' % (args[0], e))
+        if int(options['verbosity']):
+            self.stdout.write('%s BIN ranges written to %s' % (count, path))
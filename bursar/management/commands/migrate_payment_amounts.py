@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from bursar import models
+
+# vendor => ALTER statement turning float amount column into fixed exponent one
+ALTER_SQL = {
+    'postgresql': 'ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE %(type)s USING round(%(column)s::numeric, %(places)s)',
+    'mysql'     : 'ALTER TABLE %(table)s MODIFY %(column)s %(type)s NOT NULL',
+    'oracle'    : 'ALTER TABLE %(table)s MODIFY %(column)s %(type)s',
+}
+
+class Command(BaseCommand):
+    help = "Converts bursar_payment.amount column of databases created before it was fixed exponent " \
+           "(NUMERIC) from float. Prints the SQL, runs it with --execute"
+    option_list = BaseCommand.option_list + (
+        make_option('--execute',  action='store_true', default=False, help='run the statements'),
+        make_option('--database', default=DEFAULT_DB_ALIAS, help='database to convert [%default]'),
+    )
+
+    def handle(self, **options):
+        connection = connections[options['database']]
+        field = models.Payment._meta.get_field('amount')
+        qn = connection.ops.quote_name
+        vendor = connection.vendor
+
+        if vendor == 'sqlite':
+            # column type can't be altered, but SQLite stores whatever it's given:
+            # rounding existing values is enough, MoneyField reads them as Decimals
+            sql = 'UPDATE %s SET %s = round(%s, %s)' % (qn(models.Payment._meta.db_table), qn(field.column),
+                                                       qn(field.column), field.decimal_places)
+        elif vendor in ALTER_SQL:
+            sql = ALTER_SQL[vendor] % {
+                    'table' : qn(models.Payment._meta.db_table),
+                    'column': qn(field.column),
+                    'type'  : field.db_type(connection),
+                    'places': field.decimal_places,
+                }
+        else:
+            raise CommandError('Unsupported database %s' % vendor)
+
+        if not options['execute']:
+            self.stdout.write(sql + ';')
+            return
+
+        with transaction.commit_on_success(using=options['database']):
+            connection.cursor().execute(sql)
+        if int(options['verbosity']):
+            self.stdout.write('%s.%s converted to %s' % (models.Payment._meta.db_table, field.column,
+                                                         field.db_type(connection)))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bursar import models
+from bursar.reconcile import Reconciler
+
+class Command(BaseCommand):
+    help = "Updates status of payments in transitional states from their gateways. Resumable with --checkpoint"
+    option_list = BaseCommand.option_list + (
+        make_option('--rate',       type='float', default=10, help='max gateway requests per second, 0 for no limit [%default]'),
+        make_option('--workers',    type='int',   default=8,  help='concurrent gateway requests [%default]'),
+        make_option('--batch-size', type='int',   default=500, dest='batch_size', help='payments per batch [%default]'),
+        make_option('--checkpoint', help='file to keep progress in, interrupted run continues from it'),
+        make_option('--restart',    action='store_true', default=False, help='ignore saved checkpoint'),
+        make_option('--method',     action='append', help='only payments of this gateway, can be repeated'),
+        make_option('--days',       type='int', help='only payments made in last N days'),
+    )
+
+    def handle(self, **options):
+        queryset = models.Payment.objects.all()
+        if options['method']:
+            queryset = queryset.filter(method__in=options['method'])
+        if options['days']:
+            queryset = queryset.filter(time_stamp__gte=datetime.datetime.now() - datetime.timedelta(days=options['days']))
+
+        verbosity = int(options['verbosity'])
+        def progress(stats):
+            if verbosity > 1:
+                self.stdout.write('%(checked)s checked, %(changed)s changed, %(errors)s errors, '
+                                  'last id %(last_id)s, %(rate).1f payments/s' % stats)
+
+        reconciler = Reconciler(queryset,
+                                rate       = options['rate'],
+                                workers    = options['workers'],
+                                batch_size = options['batch_size'],
+                                checkpoint = options['checkpoint'],
+                                progress   = progress)
+        if options['restart']:
+            reconciler.reset()
+        stats = reconciler.run()
+        if verbosity:
+            self.stdout.write('%(checked)s payment(s) checked, %(changed)s changed, %(errors)s error(s) '
+                              'in %(elapsed).1fs, %(rate).1f payments/s' % stats)
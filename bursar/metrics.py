@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of gateway operations. Every BasePaymentProcessor operation (OPERATIONS)
+is timed; gateways split it into phases by calling mark() when a phase ends:
+
+    request_text = self.build_request(...)
+    metrics.mark('build')
+
+Each operation is reported to sinks as (gateway, operation, status, [(phase, seconds), ..]),
+with 'total' phase last and status taken from the result ('error' if it raised).
+Sinks are configured by METRICS setting, eg:
+
+    'METRICS': {
+        'statsd'    : {'host': '127.0.0.1', 'port': 8125, 'prefix': 'bursar'},
+        'prometheus': {},   # in-process histograms, served by bursar.views.metrics_view
+        'callback'  : {'function': 'myproject.monitoring.gateway_timing'},
+    }
+
+With no sinks configured operations are not timed at all. The setting is read
+on first operation, not at import.
+"""
+import time
+import socket
+import bisect
+import functools
+import threading
+
+from django.utils.importlib import import_module
+
+from bursar import settings as bursar_settings
+
+OPERATIONS = ('authorize', 'capture', 'capture_authorized', 'release_authorized', 'refund', 'get_payment_status')
+
+# histogram buckets, seconds
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+sinks = None    # configured sinks, None until get_sinks() reads METRICS setting
+registry = None # Registry if 'prometheus' sink is configured
+
+_configure_lock = threading.Lock()
+
+_local = threading.local()
+
+class Operation(object):
+    __slots__ = ('gateway', 'name', 'started', 'last', 'phases')
+
+    def __init__(self, gateway, name):
+        self.gateway = gateway
+        self.name = name
+        self.started = self.last = time.time()
+        self.phases = []
+
+def mark(phase):
+    """ ends `phase` of the operation running in this thread: time since
+        operation start or previous mark is recorded as phase duration """
+    operation = getattr(_local, 'operation', None)
+    if operation is not None:
+        now = time.time()
+        operation.phases.append((phase, now - operation.last))
+        operation.last = now
+
+def instrument(name, method):
+    """ wraps processor method to time it. Nested operations (eg capture
+        calling authorize) are part of the outer one """
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        if not get_sinks() or getattr(_local, 'operation', None) is not None:
+            return method(self, *args, **kwargs)
+        operation = _local.operation = Operation(self.key, name)
+        status = 'error'
+        try:
+            result = method(self, *args, **kwargs)
+            status = isinstance(result, dict) and result.get('status') or 'ok'
+            return result
+        finally:
+            _local.operation = None
+            operation.phases.append(('total', time.time() - operation.started))
+            record(operation.gateway, operation.name, status, operation.phases)
+    timed.instrumented = True
+    return timed
+
+def record(gateway, operation, status, phases):
+    for sink in get_sinks():
+        try:
+            sink.record(gateway, operation, status, phases)
+        except Exception:
+            pass # metrics never break payments
+
+class Registry(object):
+    """ In-process histograms and counters, rendered in Prometheus text format """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {} # (gateway, operation, phase, status) => [bucket counts.., sum, count]
+        self.counters = {}   # (gateway, operation, status) => count
+        self.lock = threading.Lock()
+
+    def record(self, gateway, operation, status, phases):
+        with self.lock:
+            key = (gateway, operation, status)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            for phase, seconds in phases:
+                key = (gateway, operation, phase, status)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-2] += seconds
+                histogram[-1] += 1
+
+    def render(self):
+        with self.lock:
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        lines = ['# HELP bursar_gateway_operations_total Gateway operations by outcome status',
+                 '# TYPE bursar_gateway_operations_total counter']
+        for (gateway, operation, status), count in counters:
+            lines.append('bursar_gateway_operations_total{gateway="%s",operation="%s",status="%s"} %d'
+                         % (gateway, operation, status, count))
+
+        lines += ['# HELP bursar_gateway_seconds Gateway operation phase durations',
+                  '# TYPE bursar_gateway_seconds histogram']
+        for (gateway, operation, phase, status), histogram in histograms:
+            labels = 'gateway="%s",operation="%s",phase="%s",status="%s"' % (gateway, operation, phase, status)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-2]):
+                cumulative += count
+                lines.append('bursar_gateway_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('bursar_gateway_seconds_sum{%s} %r' % (labels, histogram[-2]))
+            lines.append('bursar_gateway_seconds_count{%s} %d' % (labels, histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+class StatsdSink(object):
+    """ statsd timers (ms) per phase and a counter per operation, one UDP datagram per operation """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='bursar'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def record(self, gateway, operation, status, phases):
+        name = '%s.%s.%s' % (self.prefix, gateway, operation)
+        lines = ['%s.%s.%s:%.3f|ms' % (name, phase, status or 'none', seconds * 1000) for phase, seconds in phases]
+        lines.append('%s.%s:1|c' % (name, status or 'none'))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+class CallbackSink(object):
+    """ calls function(gateway, operation, status, phases), function may be a dotted path """
+    def __init__(self, function):
+        self.function = function
+
+    def record(self, gateway, operation, status, phases):
+        if isinstance(self.function, basestring):
+            module_name, func_name = self.function.rsplit('.', 1)
+            self.function = getattr(import_module(module_name), func_name)
+        self.function(gateway, operation, status, phases)
+
+SINKS = {
+    'statsd'    : StatsdSink,
+    'prometheus': Registry,
+    'callback'  : CallbackSink,
+}
+
+def configure(config):
+    """ (re)creates sinks by {sink name: options} config, see METRICS setting """
+    global sinks, registry
+    new_sinks, registry = [], None
+    for name, options in config.items():
+        sink = SINKS[name](**options)
+        if name == 'prometheus':
+            registry = sink
+        new_sinks.append(sink)
+    sinks = new_sinks
+
+def get_sinks():
+    """ sinks, configured by METRICS setting on first call """
+    if sinks is None:
+        with _configure_lock:
+            if sinks is None:
+                configure(bursar_settings.working_settings.get('METRICS') or {})
+    return sinks
+
+def get_registry():
+    """ Registry of 'prometheus' sink, None if it is not configured """
+    get_sinks()
+    return registry
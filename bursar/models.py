@@ -6,26 +6,96 @@ Also stores credit card info in an encrypted format.
 
 from datetime import datetime
 from django.conf import settings
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models.query import QuerySet
+from django.core import exceptions
 from django.core.cache import cache
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
 
 from Crypto.Cipher import Blowfish
+import hmac
 import base64
+import decimal
+import contextlib
+import hashlib
 import logging
 
-from bursar import utils
+from bursar import utils, concurrency
 from bursar.errors import GatewayError
 from bursar import settings as bursar_settings
 
 log = logging.getLogger('bursar.models')
 
+class MoneyField(models.DecimalField):
+    """ Fixed exponent amount column, NUMERIC(18, 2) by default. Values are
+        always Decimals (see utils.money), whatever is assigned, so amounts
+        add up exactly in python and in database SUMs """
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, verbose_name=None, name=None, max_digits=18, decimal_places=utils.AMOUNT_PLACES, **kwargs):
+        super(MoneyField, self).__init__(verbose_name, name, max_digits, decimal_places, **kwargs)
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return value
+        try:
+            return utils.money(value)
+        except decimal.InvalidOperation:
+            raise exceptions.ValidationError(self.error_messages['invalid'])
+
+# purchase level totals, annotation name => payment statuses summed up.
+# No refunded total: refund() lowers payment amount to what is left, so
+# refunded money is not recorded in payments
+PAYMENT_TOTALS = (
+    ('authorized_total', ('A',)),
+    ('captured_total',   ('CD', 'S')),
+)
+
+class PurchaseQuerySet(QuerySet):
+    def with_payment_totals(self, total_column=None):
+        """ Annotate purchases with PAYMENT_TOTALS sums, so list pages don't
+            query payments once per row. Pass total_column if purchase total is
+            stored in the database, to get .outstanding_total as well """
+        qn = connection.ops.quote_name
+        purchase_fk = Payment._meta.get_field('purchase')
+        subquery = 'SELECT COALESCE(SUM(%(p)s.%(amount)s), 0) FROM %(p)s WHERE %(p)s.%(fk)s = %(t)s.%(pk)s AND %(p)s.%(status)s IN (%%s)' % {
+                'p'     : qn(Payment._meta.db_table),
+                'amount': qn(Payment._meta.get_field('amount').column),
+                'status': qn(Payment._meta.get_field('status').column),
+                'fk'    : qn(purchase_fk.column),
+                't'     : qn(self.model._meta.db_table),
+                'pk'    : qn(self.model._meta.pk.column),
+            }
+
+        select, params = SortedDict(), []
+        for name, statuses in PAYMENT_TOTALS:
+            select[name] = subquery % ', '.join(['%s']*len(statuses))
+            params.extend(statuses)
+        if total_column:
+            select['outstanding_total'] = '%s.%s - (%s) - (%s)' % (qn(self.model._meta.db_table),
+                    qn(self.model._meta.get_field(total_column).column), select['captured_total'], select['authorized_total'])
+            params.extend(('CD', 'S', 'A'))
+
+        return self.extra(select=select, select_params=params)
+
+class PurchaseManager(models.Manager):
+    """ Default manager of purchase models. If you override .objects,
+        please inherit from this class to keep with_payment_totals() """
+    def get_query_set(self):
+        return PurchaseQuerySet(self.model, using=self._db)
+
+    def with_payment_totals(self, total_column=None):
+        return self.get_query_set().with_payment_totals(total_column)
+
 class PurchaseBase(models.Model):
     """ class all purchase models should inherit from
         Note that Purchase object might not have shipping information (as eg
         for digital products) and might not have billing information (eg Paypal
         or Google Checkout). So, it does not have mandatory fields except .total
     """
+    objects = PurchaseManager()
+
     class Meta:
         abstract = True
 
@@ -69,16 +139,46 @@ class PurchaseBase(models.Model):
     def captures(self):
         return self.payments.filter(status__in =('CD', 'S'))
 
+    _ledger = None
+    @property
+    def ledger(self):
+        """ {status: sum of amounts} snapshot of purchase payments.
+            Taken by a single aggregate query and kept until one of the payments
+            is changed by Payment._update (or reset_ledger() is called) """
+        if self._ledger is None:
+            self._ledger = dict(self.payments.order_by().values_list('status').annotate(models.Sum('amount')))
+        return self._ledger
+
+    def reset_ledger(self):
+        self._ledger = None
+        # values annotated by with_payment_totals() are stale as well
+        for name, statuses in PAYMENT_TOTALS:
+            self.__dict__.pop(name, None)
+        self.__dict__.pop('outstanding_total', None)
+
+    def _payment_total(self, name):
+        if name in self.__dict__: # annotated by PurchaseQuerySet.with_payment_totals()
+            return utils.money(self.__dict__[name])
+        ledger = self.ledger
+        return utils.money(sum(ledger.get(status, 0) for status in dict(PAYMENT_TOTALS)[name]))
+
     @property
     def authorized_amount(self):
-        return reduce(lambda x,y: x+y.amount, self.authorizations, 0)
+        return self._payment_total('authorized_total')
 
     @property
     def captured_amount(self):
-        return reduce(lambda x,y: x+y.amount, self.captures, 0)
+        return self._payment_total('captured_total')
+
+    @property
+    def outstanding_amount(self):
+        if 'outstanding_total' in self.__dict__:
+            return utils.money(self.__dict__['outstanding_total'])
+        return utils.money(self.total) - self.captured_amount - self.authorized_amount
 
     def authorize(self, method, form_data, amount=None):
-        max_amount = self.total - self.captured_amount - self.authorized_amount
+        max_amount = self.outstanding_amount
+        amount = utils.money(amount)
         if amount is None:
             amount = max_amount
         elif amount > max_amount:
@@ -90,7 +190,8 @@ class PurchaseBase(models.Model):
         return payment.authorize(form_data)
 
     def capture(self, method, form_data, amount=None):
-        max_amount = self.total - self.captured_amount
+        max_amount = utils.money(self.total) - self.captured_amount
+        amount = utils.money(amount)
         if amount is None:
             amount = max_amount
         elif amount > max_amount:
@@ -98,20 +199,18 @@ class PurchaseBase(models.Model):
         elif amount <= 0:
             raise ValueError('Invalid amount')
 
-        amount2capture = amount
-
         #First, try to capture authorized payments
-        for p in self.authorizations:
-            if p.capture(min(amount2capture, p.amount)).success:
-                amount2capture -= p.amount
-                if amount2capture <= 0:
-                    return p
+        captured, amount2capture = self._spread(self.authorizations.order_by('id'), amount, 'capture_authorized',
+                                                lambda p, part, before: part if p.success else 0)
+        if captured and amount2capture <= 0:
+            return captured[-1]
 
         payment = Payment(method=method, purchase=self, amount=amount2capture)
         return payment.capture(form_data)
 
     def capture_authorized(self, amount=None):
         max_amount = self.authorized_amount
+        amount = utils.money(amount)
         if amount is None:
             amount = max_amount
         elif amount > max_amount:
@@ -119,22 +218,19 @@ class PurchaseBase(models.Model):
         elif amount <= 0:
             raise ValueError('Invalid amount')
 
-        ids = []
-        amount2capture = amount
-        for p in self.authorizations:
-            if p.capture_authorized(min(amount2capture, p.amount)).success:
-                amount2capture -= p.amount
-                ids.append(p.id)
-                if amount2capture <= 0:
-                    break
-        return self.payments.filter(id__in=ids)
+        captured, amount2capture = self._spread(self.authorizations.order_by('id'), amount, 'capture_authorized',
+                                                lambda p, part, before: part if p.success else 0)
+        return self.payments.filter(id__in=[p.id for p in captured])
 
     def cancel(self):
-        ids = [p.id for p in self.authorizations|self.captures if not p.cancel().success ]
+        calls = [(p, 'release_authorized', ()) if p.status == 'A' else (p, 'refund', (p.amount,))
+                 for p in self.authorizations|self.captures]
+        ids = [p.id for p in self._gateway_calls(calls) if not p.success]
         return self.payments.filter(id__in=ids)
 
     def refund(self, amount=None):
         max_refund = self.captured_amount
+        amount = utils.money(amount)
         if amount is None:
             amount = max_refund
         elif amount > max_refund:
@@ -142,36 +238,85 @@ class PurchaseBase(models.Model):
         elif amount < 0:
             raise ValueError('Can not capture negative amount')
 
-        ids = []
-        amount2refund = amount
-        for p in self.captures:
-            amount2refund -= p.amount - p.refund(min(amount2refund, p.amount)).amount
-            ids.append(p.id)
-            if amount2refund <= 0:
-                break
-        return self.payments.filter(id__in=ids)
+        refunded, amount2refund = self._spread(self.captures.order_by('id'), amount, 'refund',
+                                               lambda p, part, before: before - p.amount, keep_failed=True)
+        return self.payments.filter(id__in=[p.id for p in refunded])
+
+    def _gateway_calls(self, calls):
+        """ Runs gateway calls [(payment, processor method, args), ..] of an operation.
+            They are independent, so up to PURCHASE_CONCURRENCY of them are in flight at once.
+            Results are applied to payments in calls order in this thread; if some calls
+            failed, the first error is raised after results of the others are recorded.
+            Returns payments """
+        outcomes = concurrency.fan_out([(getattr(payment.processor, method), (payment,) + args)
+                                        for payment, method, args in calls], bursar_settings.PURCHASE_CONCURRENCY)
+        error = None
+        for (payment, method, args), (result, exception) in zip(calls, outcomes):
+            if exception is None:
+                payment._update(result)
+            elif error is None:
+                error = exception
+        if error is not None:
+            raise error
+        return [payment for payment, method, args in calls]
+
+    def _spread(self, payments, amount, method, done, keep_failed=False):
+        """ Spreads amount over payments, in order, and runs processor `method`
+            for each part concurrently. done(payment, part, amount before) tells
+            which part of the amount was processed; parts of failed calls are
+            spread over the next payments in another round.
+            Returns (payments processed, amount left) """
+        payments = list(payments)
+        processed = []
+        while amount > 0 and payments:
+            parts = []
+            left = amount
+            while left > 0 and payments:
+                payment = payments.pop(0)
+                part = min(left, payment.amount)
+                if part <= 0:
+                    continue
+                parts.append((payment, part, payment.amount))
+                left -= part
+            self._gateway_calls([(payment, method, (part,)) for payment, part, before in parts])
+            for payment, part, before in parts:
+                amount_done = done(payment, part, before)
+                amount -= amount_done
+                if amount_done or keep_failed:
+                    processed.append(payment)
+        return processed, amount
 
     def auto_authorize(self, method, form_data):
-        amount = self.total - self.captured_amount - self.authorized_amount
+        amount = self.outstanding_amount
         if amount > 0:
             return self.authorize(method, form_data, amount)
         return None
 
     def auto_capture(self, method, form_data):
         """ depending on purchase amount, issues (partial) refund or captures necessary amount """
+        total            = utils.money(self.total)
         captured_amount  = self.captured_amount
         authorized_amount= self.authorized_amount
-        if self.total <= captured_amount: # captured too much, issue refund
+        if total <= captured_amount: # captured too much, issue refund
             [p.cancel() for p in self.authorizations]
-            return self.refund(captured_amount - self.total)
-        elif captured_amount < self.total <= authorized_amount:
-            p = self.capture_authorized(self.total-captured_amount)
+            return self.refund(captured_amount - total)
+        elif captured_amount < total <= authorized_amount:
+            p = self.capture_authorized(total-captured_amount)
             [p.cancel() for p in self.authorizations]
             return p
 
-        # self.total > (captured_amount + authorized_amount):
+        # total > (captured_amount + authorized_amount):
         self.capture_authorized()
-        return self.capture(method, form_data, self.total - self.captured_amount)
+        return self.capture(method, form_data, total - self.captured_amount)
+
+    # asynchronous API, see concurrency.py
+    aauthorize          = concurrency.async_method('authorize')
+    acapture            = concurrency.async_method('capture')
+    acapture_authorized = concurrency.async_method('capture_authorized')
+    acancel             = concurrency.async_method('cancel')
+    arefund             = concurrency.async_method('refund')
+    aauto_authorize     = concurrency.async_method('auto_authorize')
+    aauto_capture       = concurrency.async_method('auto_capture')
 
 """
 General payment status diagram:
@@ -210,21 +355,148 @@ states = (
     ('RF', 'Refunded'),
     ('CB', 'Charged back'),
 )
+STATE_NAMES = dict(states)
+
+# legal status changes as of diagram above. Listed explicitly, including the
+# steps gateways may skip when reporting a payment (eg a new payment already
+# settled), but never back: a late CAPTURED or CANCELLED notification must not
+# move a settled or refunded payment
+_moves = (
+    ('',   ('A', 'R', 'E', 'CD', 'S')),
+    ('A',  ('C', 'EX', 'CD', 'S', 'RF')),
+    ('CD', ('S', 'RF', 'CB', 'C')), # capture cancelled before settlement
+    ('S',  ('RF', 'CB')),
+    ('RF', ('CB',)), # chargeback after refund
+    ('CB', ('S',)), # chargeback reversed
+)
+
+def _compile_transitions(moves):
+    """ {status: frozenset of statuses it can be changed to, including itself} """
+    graph = dict(moves)
+    return dict((status, frozenset((status,) + graph.get(status, ()))) for status, name in states)
+
+TRANSITIONS = _compile_transitions(_moves)
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+def atomic(using=None):
+    """ commit_on_success block, unless the caller manages the transaction (eg
+        TransactionMiddleware or commit_manually): a nested commit_on_success
+        would commit or roll back the caller's whole transaction. Then
+        atomicity is left to the caller """
+    if transaction.is_managed(using=using):
+        return _nothing()
+    return transaction.commit_on_success(using=using)
+
+class PaymentManager(models.Manager):
+    """ Batch operations on many payments, eg end of day capture.
+        Gateways get all modifications at once (see BasePaymentProcessor.*_many),
+        results are written with few bulk UPDATEs instead of one save per payment """
+    def capture_authorized_many(self, queryset):
+        """ capture authorized payments at full amount, returns list of captured payments """
+        return self._modify_many(queryset.filter(status='A'), 'capture_authorized_many',
+                                 lambda payment: (payment, payment.amount))
+
+    def release_authorized_many(self, queryset):
+        """ cancel authorized payments, returns list of cancelled payments """
+        return self._modify_many(queryset.filter(status='A'), 'release_authorized_many',
+                                 lambda payment: payment)
+
+    def refund_many(self, queryset):
+        """ refund captured and settled payments in full, returns list of refunded payments """
+        return self._modify_many(queryset.filter(status__in=('CD', 'S')), 'refund_many',
+                                 lambda payment: (payment, payment.amount))
+
+    def update_status_many(self, queryset, limit=None):
+        """ query current status of payments in transitional states, up to `limit`
+            (FANOUT_WORKERS by default) gateway calls at once. Returns list of changed payments """
+        payments = list(queryset.filter(status__in=('', 'A', 'CD', 'S')))
+        outcomes = concurrency.fan_out([(payment.processor.get_payment_status, (payment,)) for payment in payments],
+                                       limit or bursar_settings.FANOUT_WORKERS)
+        results = {}
+        for payment, (result, exception) in zip(payments, outcomes):
+            if exception is None:
+                results[payment.id] = result
+            else:
+                log.error('Can not get status of %s: %s', payment, exception)
+        return self.bulk_update(payments, results)
+
+    def _modify_many(self, queryset, method, argument):
+        payments = list(queryset)
+        by_gateway = {}
+        for payment in payments:
+            by_gateway.setdefault(payment.method, []).append(payment)
+
+        results = {}
+        for gateway, gateway_payments in by_gateway.items():
+            processor = utils.get_processor_instance(gateway)
+            results.update(getattr(processor, method)([argument(payment) for payment in gateway_payments]))
+
+        return self.bulk_update(payments, results)
+
+    def bulk_update(self, payments, results, batch_size=500):
+        """ Payment._update for many payments at once: applies {payment.id: data_dict}
+            with one UPDATE per distinct set of new values and a bulk insert of notes.
+            Returns list of changed payments """
+        groups, notes, updated = {}, [], []
+        for payment in payments:
+            if payment.id not in results:
+                continue
+            try:
+                changes = payment._apply(results[payment.id])
+            except ValueError:
+                log.exception('Can not apply %s to %s', results[payment.id], payment)
+                continue
+            if changes:
+                values = tuple((field, getattr(payment, field)) for field in payment._dirty_fields())
+                groups.setdefault(values, []).append(payment.id)
+                notes.append(PaymentNote(payment=payment, note=payment._changes_note(changes)))
+                updated.append(payment)
+
+        with atomic(using=self.db):
+            for values, ids in groups.items():
+                for start in range(0, len(ids), batch_size):
+                    self.filter(id__in=ids[start:start+batch_size]).update(**dict(values))
+            PaymentNote.objects.bulk_create(notes, batch_size=batch_size)
+
+        for payment in updated:
+            payment._remember_saved(payment._tracked_fields)
+            payment._reset_purchase_ledger()
+        return updated
 
 class Payment(models.Model):
     """ A payment attempt on a purchase. """
     time_stamp = models.DateTimeField(_("timestamp"), db_index=True, editable=False, auto_now_add=True)
-    method = models.CharField(_("Payment method"), choices=bursar_settings.ACTIVE_GATEWAYS, max_length=25)
-    amount = models.FloatField(_("amount"), default=0)
+    method = models.CharField(_("Payment method"), choices=bursar_settings.GatewayChoices(), max_length=25)
+    amount = MoneyField(_("amount"), default=0)
     status = models.CharField(_("Payment status"), db_index=True, choices=states, max_length=2, default='')
     details = models.CharField(_("Payment details"), max_length=255, blank=True, default="")
     transaction_id = models.CharField(_("Transaction ID"), max_length=45, blank=True, null=True)
     reason = models.CharField(_('Reason'),  max_length=255, default="")
 
-    purchase = models.ForeignKey(bursar_settings.PURCHASE_MODEL, related_name="payments")
+    purchase = models.ForeignKey(bursar_settings.configured('PURCHASE_MODEL'), related_name="payments")
+
+    objects = PaymentManager()
+
+    # fields changed by payment lifecycle. Saved values are kept to write changed columns only
+    _tracked_fields = ('amount', 'status', 'details', 'transaction_id', 'reason')
 
     def __init__(self, *args, **kwargs):
         super(Payment, self).__init__(*args, **kwargs)
+        self._saved_values = {}
+        if self.pk:
+            self._remember_saved(self._tracked_fields)
+
+    def _remember_saved(self, fields):
+        for field in fields:
+            if field in self.__dict__: # deferred fields are not loaded
+                self._saved_values[field] = self.__dict__[field]
+
+    def save(self, *args, **kwargs):
+        super(Payment, self).save(*args, **kwargs)
+        self._remember_saved(kwargs.get('update_fields') or self._tracked_fields)
 
     def __unicode__(self):
         return u"Payment #%(id)s: amount=%(amount)s (%(state)s)" % {
@@ -233,37 +505,59 @@ class Payment(models.Model):
                 'state' :self.status_name,
             }
 
-    def _update(self, data_dict):
+    def _apply(self, data_dict):
+        """ sets data_dict values, returns list of (property, old value, new value) changes """
         changes = []
         for property, new_value in data_dict.items():
             if hasattr(self, property):
                 old_value = getattr(self, property)
                 if old_value != new_value:
-                    setattr(self, property, new_value)
                     if property == 'status':
-                        changes.append((property, dict(states)[old_value], dict(states)[new_value]))
+                        if new_value not in TRANSITIONS[old_value]:
+                            raise ValueError('Illegal payment status change: %s => %s'%(old_value, new_value))
+                        changes.append((property, STATE_NAMES[old_value], STATE_NAMES[new_value]))
                     else:
                         changes.append((property, old_value, new_value))
+                    setattr(self, property, new_value)
+        return changes
+
+    def _dirty_fields(self):
+        """ tracked fields changed since last save, eg by _apply or processor (transaction_id) """
+        return [field for field in self._tracked_fields
+                if field not in self._saved_values or getattr(self, field) != self._saved_values[field]]
+
+    @staticmethod
+    def _changes_note(changes):
+        return "\n".join(("%s: %s => %s"%change for change in changes))
+
+    def _update(self, data_dict):
+        changes = self._apply(data_dict)
         if changes:
-            self.save()
-            self.notes.create(payment=self, note="\n".join(("%s: %s => %s"%change for change in changes))).save()
+            update_fields = self._dirty_fields() if self.pk else None
+            with atomic(using=self._state.db):
+                self.save(update_fields=update_fields)
+                self.notes.create(payment=self, note=self._changes_note(changes))
+            self._reset_purchase_ledger()
 
         return self
 
-    _processor = None
+    def _reset_purchase_ledger(self):
+        """ drop ledger snapshot of the purchase instance bound to this payment, if any """
+        purchase = getattr(self, self._meta.get_field('purchase').get_cache_name(), None)
+        if purchase is not None:
+            purchase.reset_ledger()
+
     @property
     def processor(self):
-        if self._processor is None:
-            try:
-                processor_class = utils.get_processor(self.method)
-            except:
-                raise ImportError('You have to specify method for Payment instance')
-            self._processor = processor_class(self)
-        return self._processor
+        """ gateway processor, shared with all other payments of this method """
+        try:
+            return utils.get_processor_instance(self.method)
+        except (ImportError, TypeError):
+            raise ImportError('You have to specify method for Payment instance')
 
     @property
     def status_name(self):
-        return dict(states).get(self.status)
+        return STATE_NAMES.get(self.status)
 
     @property
     def success(self):
@@ -273,7 +567,7 @@ class Payment(models.Model):
         if self.amount != 0 and not self.status: #authorization available only for new payments
             if not self.id:
                 self.save()
-            return self._update(self.processor.authorize(form_data))
+            return self._update(self.processor.authorize(self, form_data))
         if self.amount < 0:
             raise ValueError('Can not authorize negative amount')
         return self
@@ -282,44 +576,53 @@ class Payment(models.Model):
         if self.amount > 0 and not self.status: #new payment
             if not self.id:
                 self.save()
-            return self._update(self.processor.capture(form_data))
+            return self._update(self.processor.capture(self, form_data))
         if self.amount <= 0:
             raise ValueError('Invalid amount')
         return self
 
     def capture_authorized(self, amount=None):
         if self.status == 'A':
-            if amount is None:
-                amount = self.amount
+            amount = self.amount if amount is None else utils.money(amount)
             if amount > self.amount:
                 raise ValueError('Can not capture above authorized amount')
-            return self._update(self.processor.capture_authorized(amount))
+            return self._update(self.processor.capture_authorized(self, amount))
         return self
 
     def cancel(self):
         """ cancel auth or refund at full """
         if self.status == 'A': #authorized: cancel
-            return self._update(self.processor.release_authorized())
+            return self._update(self.processor.release_authorized(self))
         elif self.status in ('CD', 'S'): #captured, settled: refund
-            return self._update(self.processor.refund(self.amount))
+            return self._update(self.processor.refund(self, self.amount))
         return self
 
     def refund(self, amount):
         """ Partial refund """
+        amount = utils.money(amount)
         if self.status in ('CD', 'S') and amount > 0: #refundable states: captured, settled
             if amount > self.amount:
                 raise ValueError('Can not refund above authorized amount')
-            return self._update(self.processor.refund(amount))
+            return self._update(self.processor.refund(self, amount))
         return self
 
     def update_status(self):
         if self.status in ('', 'A', 'CD', 'S'): #transitional states: authorized, captured, settled
-            return self._update(self.processor.get_payment_status())
+            return self._update(self.processor.get_payment_status(self))
         return self
 
+    # asynchronous API, see concurrency.py
+    aauthorize          = concurrency.async_method('authorize')
+    acapture            = concurrency.async_method('capture')
+    acapture_authorized = concurrency.async_method('capture_authorized')
+    acancel             = concurrency.async_method('cancel')
+    arefund             = concurrency.async_method('refund')
+    aupdate_status      = concurrency.async_method('update_status')
+
     class Meta:
         verbose_name = _("Payment")
         verbose_name_plural = _("Payments")
+        index_together = (('purchase', 'status'),) # used by PurchaseBase.ledger
 
 class PaymentNote(models.Model):
     time_stamp = models.DateTimeField(_("timestamp"), editable=False, auto_now_add=True)
@@ -338,6 +641,50 @@ For other forms of payment to be stored, please create a similar model in gatewa
 or in .details property of the Payment
 """
 
+class CreditCardDetailManager(models.Manager):
+    def decrypt_many(self, cards):
+        """ Loads card numbers and CCVs of a page of cards (eg admin or export)
+            with a single cache.get_many and one cipher context.
+            Returns cards, their .card_no and .ccv don't touch cache afterwards """
+        pending = [(card, card._key(), card._key('ccv')) for card in cards
+                   if card.id and not card._secrets_loaded]
+        keys = [ccv_key for card, card_key, ccv_key in pending]
+        keys.extend(card_key for card, card_key, ccv_key in pending if not card.encrypted_cc)
+        cached = cache.get_many(keys) if keys else {}
+        missing = set(keys).difference(cached)
+        if missing:
+            cached.update(self._move_legacy_keys(pending, missing))
+
+        encrypted = [] # [(card, code), ..]
+        for card, card_key, ccv_key in pending:
+            card._secrets_loaded = True
+            if not card._ccv:
+                card._ccv = cached.get(ccv_key, "")
+            if not card._card_no:
+                code = card.encrypted_cc or cached.get(card_key)
+                if code:
+                    encrypted.append((card, code))
+        if encrypted:
+            for (card, code), card_no in zip(encrypted, decrypt_many([code for card, code in encrypted])):
+                card._card_no = card_no
+        return cards
+
+    def _move_legacy_keys(self, pending, missing):
+        """ Secrets cached before cache keys were HMACs, moved to current keys.
+            Without STORE_CREDIT_NUMBERS cache is the only copy of card numbers.
+            Not needed once CACHE_TIMEOUT passed since upgrade """
+        legacy = {} # legacy key => current key
+        for card, card_key, ccv_key in pending:
+            for key, type in ((card_key, 'card'), (ccv_key, 'ccv')):
+                if key in missing:
+                    legacy[card._legacy_key(type)] = key
+        found = cache.get_many(legacy.keys())
+        moved = dict((legacy[key], value) for key, value in found.items())
+        if moved:
+            cache.set_many(moved, bursar_settings.CACHE_TIMEOUT)
+            cache.delete_many(found.keys())
+        return moved
+
 class CreditCardDetail(models.Model):
     """ Stores an encrypted CC number, its information, and its displayable number.
         Payment processor responsible for storing this data """
@@ -350,13 +697,20 @@ class CreditCardDetail(models.Model):
     start_date  = models.DateField(_("Start date"), blank=True, null=True, editable=False)
     issue_num   = models.CharField(default="", max_length=2, editable=False)
 
+    objects = CreditCardDetailManager()
+
      #temporary storage for values to be encrypted
     _card_no = ""
     _ccv     = ""
+    _secrets_loaded = False # card number and CCV were looked up, see decrypt_many
 
     def _key(self, type='card'):
-        raw_key = ":".join((str(self.id), self.card_type, self.name, self.display_cc, self.expirationDate, type))
-        return _encrypt_code(raw_key)
+        raw_key = u":".join((unicode(self.id), self.card_type, self.name, self.display_cc, self.expirationDate, type))
+        return _cache_key(raw_key)
+
+    def _legacy_key(self, type='card'):
+        """ cache key used before _cache_key """
+        return _encrypt_code(u":".join((unicode(self.id), self.card_type, self.name, self.display_cc, self.expirationDate, type)))
 
     def setCCV(self, ccv):
         """ Put the CCV in the cache, don't save it for security/legal reasons. """
@@ -364,7 +718,9 @@ class CreditCardDetail(models.Model):
 
     def getCCV(self):
         """Get the CCV from cache"""
-        return self._ccv or cache.get(self._key('ccv')) or ""
+        if not self._ccv:
+            CreditCardDetail.objects.decrypt_many([self])
+        return self._ccv or ""
 
     ccv = property(fget=getCCV, fset=setCCV)
 
@@ -375,19 +731,9 @@ class CreditCardDetail(models.Model):
         self.display_cc= ccnum[-4:]
 
     def decryptedCC(self):
-        if self._card_no: # we're in the same session
-            return self._card_no
-
-        encrypted = None
-        if self.encrypted_cc:
-            encrypted = _decrypt_code(self.encrypted_cc)
-        elif self.id:
-            encrypted = cache.get(self._key())
-
-        if encrypted is not None:
-            return _decrypt_code(encrypted)
-
-        return '*'*12 + self.display_cc
+        if not self._card_no:
+            CreditCardDetail.objects.decrypt_many([self])
+        return self._card_no or '*'*12 + self.display_cc
 
     card_no = property(fget=decryptedCC, fset=storeCC)
 
@@ -417,20 +763,36 @@ class CreditCardDetail(models.Model):
         verbose_name_plural = _("Credit Cards")
 
 
+_ciphers = {}
+
+def _cipher(key=None):
+    """ Blowfish key setup is deliberately expensive, so contexts are kept
+        per process, keyed by key. ECB contexts are stateless and can be shared """
+    key = key or settings.SECRET_KEY
+    cipher = _ciphers.get(key)
+    if cipher is None:
+        cipher = _ciphers[key] = Blowfish.new(key)
+    return cipher
+
+def _cache_key(raw_key):
+    """ Cache key for card secrets, HMAC of raw_key with SECRET_KEY """
+    return 'bursar.card:' + hmac.new(settings.SECRET_KEY, raw_key.encode('utf8'), hashlib.sha1).hexdigest()
+
 def _decrypt_code(code):
     """Decrypt code encrypted by _encrypt_code"""
-    secret_key = settings.SECRET_KEY
-    encryption_object = Blowfish.new(secret_key)
     # strip padding from decrypted credit card number
-    return encryption_object.decrypt(base64.b64decode(code)).rstrip('X')
+    return _cipher().decrypt(base64.b64decode(code)).rstrip('X')
+
+def decrypt_many(codes):
+    """Decrypt a sequence of codes encrypted by _encrypt_code"""
+    cipher = _cipher()
+    return [cipher.decrypt(base64.b64decode(code)).rstrip('X') for code in codes]
 
 def _encrypt_code(code):
     """Quick encrypter for CC codes or code fragments"""
     code = code.encode('utf8')
-    secret_key = settings.SECRET_KEY
-    encryption_object = Blowfish.new(secret_key)
     # block cipher length must be a multiple of 8
     padding = ''
     if (len(code) % 8) <> 0:
         padding = 'X' * (8 - (len(code) % 8))
-    return base64.b64encode(encryption_object.encrypt(code + padding))
+    return base64.b64encode(_cipher().encrypt(code + padding))
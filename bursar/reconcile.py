@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Reconciliation of payments in transitional states ('', 'A', 'CD', 'S') with
+gateways, eg nightly:
+
+    stats = Reconciler(rate=20, workers=8, checkpoint='/var/tmp/reconcile.json').run()
+
+Payments are read in primary key order, batch_size at a time (keyset
+pagination on the status index, constant memory on any table size).
+get_payment_status calls of a batch run on a worker pool, all of them together
+at most `rate` per second; changes are written with PaymentManager.bulk_update.
+After each batch the last payment id is saved to `checkpoint` file, so an
+interrupted run continues where it stopped. A complete run removes it: the
+next one starts over.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from django.db import reset_queries
+
+from bursar import concurrency, models
+
+log = logging.getLogger('bursar.reconcile')
+
+TRANSITIONAL = ('', 'A', 'CD', 'S')
+
+class RateLimiter(object):
+    """ Spaces calls of all threads evenly, at most `rate` per second. rate=0 means no limit """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class Reconciler(object):
+    def __init__(self, queryset=None, rate=10, workers=8, batch_size=500, checkpoint=None, progress=None):
+        """ queryset   - payments to look at, all by default; narrowed down to transitional ones
+            rate       - max get_payment_status calls per second, 0 for no limit
+            checkpoint - file name to keep last processed payment id in
+            progress   - callable getting stats dict after each batch """
+        if queryset is None:
+            queryset = models.Payment.objects.all()
+        self.queryset = queryset.filter(status__in=TRANSITIONAL).order_by('id')
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.stats = {
+            'checked' : 0,
+            'changed' : 0,
+            'errors'  : 0,
+            'last_id' : self.load_checkpoint(),
+            'elapsed' : 0,
+            'rate'    : 0,
+        }
+
+    def load_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint:
+                return json.load(checkpoint)['last_id']
+        return 0
+
+    def save_checkpoint(self, last_id):
+        if self.checkpoint:
+            # write and rename, so an interrupted write never loses the previous checkpoint
+            with open(self.checkpoint + '.tmp', 'w') as checkpoint:
+                json.dump({'last_id': last_id}, checkpoint)
+            os.rename(self.checkpoint + '.tmp', self.checkpoint)
+
+    def reset(self):
+        """ start over on next run """
+        self.stats['last_id'] = 0
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def get_status(self, payment):
+        self.limiter.wait()
+        return payment.processor.get_payment_status(payment)
+
+    def run(self):
+        """ reconciles all remaining payments, returns stats """
+        executor = None
+        if concurrency.futures is not None and self.workers > 1:
+            executor = concurrency.futures.ThreadPoolExecutor(self.workers)
+        started = time.time()
+        try:
+            while True:
+                payments = list(self.queryset.filter(id__gt=self.stats['last_id'])[:self.batch_size])
+                if not payments:
+                    break
+                self.reconcile(payments, executor)
+                self.stats['last_id'] = payments[-1].id
+                self.save_checkpoint(payments[-1].id)
+
+                self.stats['elapsed'] = time.time() - started
+                self.stats['rate'] = self.stats['checked'] / self.stats['elapsed'] if self.stats['elapsed'] else 0
+                if self.progress:
+                    self.progress(dict(self.stats))
+                reset_queries() # don't collect millions of queries with DEBUG on
+            self.reset()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.stats
+
+    def reconcile(self, payments, executor=None):
+        outcomes = concurrency.fan_out([(self.get_status, (payment,)) for payment in payments],
+                                       self.workers, executor)
+        results = {}
+        for payment, (result, exception) in zip(payments, outcomes):
+            if exception is None:
+                results[payment.id] = result
+            else:
+                log.error('Can not get status of %s: %s', payment.id, exception)
+                self.stats['errors'] += 1
+        self.stats['checked'] += len(payments)
+        self.stats['changed'] += len(models.Payment.objects.bulk_update(payments, results))
@@ -1,48 +1,177 @@
 # -*- coding: utf-8 -*-
+"""
+Bursar settings. Nothing is computed on import: gateways are found and
+BURSAR_SETTINGS are merged on first access of any of the RESOLVED names, so
+processes which never touch payments don't pay for it.
+
+Gateways are found, in order of preference, by:
+ - explicit declaration, the cheapest: only the listed apps are imported
+       BURSAR_SETTINGS = {'GATEWAYS': ('bursar.gateway.worldpay', ..), ..}
+ - discovery manifest: JSON file keeping result of INSTALLED_APPS scan,
+   rescanned and rewritten when INSTALLED_APPS change
+       BURSAR_SETTINGS = {'GATEWAY_MANIFEST': '/var/cache/myproject/bursar-gateways.json', ..}
+ - scan of INSTALLED_APPS for modules with PROCESSOR_KEY, which imports all of them
+"""
+import os
+import sys
+import json
+import types
+import hashlib
+import logging
+import threading
 
 from django.conf import settings
-from django.utils.translation import ugettext_lazy as _
 from django.utils import importlib
 
-working_settings = {
+log = logging.getLogger('bursar.settings')
+
+DEFAULTS = {
     'STORE_CREDIT_NUMBERS' : False,
     'MAKE_TEST_PURCHASE': None,
     'PURCHASE_MODEL' : 'bursar.Purchase',
     'LIVE'           : False,
     'CACHE_TIMEOUT'  : 3000000,  # ~35 days by default
+    'EXECUTOR_WORKERS': 8,       # threads serving asynchronous API, see concurrency.py
+    'FANOUT_WORKERS' : 16,       # threads running gateway calls of purchase operations
+    'PURCHASE_CONCURRENCY': 1,   # max gateway calls in flight per purchase operation, 1 to run them one by one
+    'METRICS'        : {},       # gateway operation timing sinks, see metrics.py
+    'METRICS_ADDRESSES': (),     # addresses metrics_view serves besides staff users, eg Prometheus server
+    'BIN_DATABASE'   : None,     # compiled BIN ranges file, see bins.py
+    'BIN_DATABASE_CHECK': 10,    # seconds between checks whether BIN_DATABASE file was replaced
 }
 
-ACTIVE_GATEWAYS = []
-for app in settings.INSTALLED_APPS:
+# module level shortcuts of working_settings
+CONSTANTS = ('STORE_CREDIT_NUMBERS', 'PURCHASE_MODEL', 'LIVE', 'CACHE_TIMEOUT',
+             'EXECUTOR_WORKERS', 'FANOUT_WORKERS', 'PURCHASE_CONCURRENCY')
+
+RESOLVED = frozenset(('working_settings', 'ACTIVE_GATEWAYS', 'DEFAULT_GATEWAY') + CONSTANTS)
+
+_resolved = False
+_lock = threading.Lock()
+
+def discover_gateways(installed_apps):
+    """ [(gateway name, app module), ..] of installed apps defining PROCESSOR_KEY """
+    gateways = []
+    for app in installed_apps:
+        try:
+            module = importlib.import_module(app)
+        except ImportError:
+            continue
+        if hasattr(module, 'PROCESSOR_KEY'):
+            gateways.append((app.rsplit('.', 1)[-1], app))
+    return gateways
+
+def load_manifest(path, installed_apps):
+    """ gateways stored in manifest, None if it is missing or INSTALLED_APPS changed since """
     try:
-        module = importlib.import_module(app)
-    except ImportError:
-        continue
-    if hasattr(module, 'PROCESSOR_KEY'):
-        appname = app.rsplit('.', 1)[-1]
-        ACTIVE_GATEWAYS.append((appname, app))
-        if hasattr(module, 'DEFAULT_SETTINGS'):
-            working_settings[getattr(module, 'PROCESSOR_KEY')] = getattr(module, 'DEFAULT_SETTINGS')
-
-if hasattr(settings, 'BURSAR_SETTINGS'):
-    for key, value in settings.BURSAR_SETTINGS.items():
-        if key in working_settings and isinstance(value, dict):
-            working_settings[key].update(value)
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('installed_apps') != _fingerprint(installed_apps):
+        return None
+    return [tuple(gateway) for gateway in manifest['gateways']]
+
+def save_manifest(path, installed_apps, gateways):
+    try:
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump({'installed_apps': _fingerprint(installed_apps), 'gateways': gateways}, manifest_file)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError), e:
+        log.warning('Can not write gateway manifest %s: %s', path, e)
+
+def _fingerprint(installed_apps):
+    return hashlib.sha1('\n'.join(installed_apps)).hexdigest()
+
+def find_gateways(bursar_settings):
+    declared = bursar_settings.get('GATEWAYS')
+    if declared is not None:
+        return [(app.rsplit('.', 1)[-1], app) for app in declared]
+
+    installed_apps = list(settings.INSTALLED_APPS)
+    manifest = bursar_settings.get('GATEWAY_MANIFEST')
+    gateways = manifest and load_manifest(manifest, installed_apps)
+    if gateways is None:
+        gateways = discover_gateways(installed_apps)
+        if manifest:
+            save_manifest(manifest, installed_apps, gateways)
+    return gateways
+
+def setup():
+    """ finds gateways and merges their DEFAULT_SETTINGS with BURSAR_SETTINGS. Runs once """
+    global _resolved, working_settings, ACTIVE_GATEWAYS, DEFAULT_GATEWAY
+    if _resolved:
+        return
+    with _lock:
+        if _resolved:
+            return
+        bursar_settings = getattr(settings, 'BURSAR_SETTINGS', {})
+        working = dict(DEFAULTS, METRICS=dict(DEFAULTS['METRICS']))
+        gateways = find_gateways(bursar_settings)
+        for name, app in gateways:
+            module = importlib.import_module(app)
+            if hasattr(module, 'DEFAULT_SETTINGS'):
+                working[module.PROCESSOR_KEY] = dict(module.DEFAULT_SETTINGS)
+
+        for key, value in bursar_settings.items():
+            if key in working and isinstance(value, dict):
+                working[key].update(value)
+            else:
+                working[key] = value
+
+        for name in CONSTANTS:
+            globals()[name] = working[name]
+
+        default_gateway = working.get('DEFAULT_GATEWAY')
+        if gateways:
+            if default_gateway not in dict(gateways):
+                default_gateway = gateways[0][0]
         else:
-            working_settings[key] = value
+            default_gateway = ''
+
+        working_settings, ACTIVE_GATEWAYS, DEFAULT_GATEWAY = working, gateways, default_gateway
+        _resolved = True
+
+def configured(name):
+    """ setting as given in BURSAR_SETTINGS or DEFAULTS, without setup(). For
+        values needed at import time that gateways don't change, eg PURCHASE_MODEL """
+    return getattr(settings, 'BURSAR_SETTINGS', {}).get(name, DEFAULTS.get(name))
+
+class GatewayChoices(object):
+    """ ACTIVE_GATEWAYS as field choices, looked up on use: models can be
+        imported without resolving settings """
+    def __nonzero__(self):
+        return True # Field.__init__ and contribute_to_class test choices, don't resolve for it
 
-STORE_CREDIT_NUMBERS= working_settings['STORE_CREDIT_NUMBERS']
-PURCHASE_MODEL      = working_settings['PURCHASE_MODEL']
-LIVE                = working_settings['LIVE']
-CACHE_TIMEOUT       = working_settings['CACHE_TIMEOUT']
+    def __iter__(self):
+        return iter(_lazy_module.ACTIVE_GATEWAYS)
 
-DEFAULT_GATEWAY = working_settings.get('DEFAULT_GATEWAY')
-if ACTIVE_GATEWAYS:
-    if DEFAULT_GATEWAY not in dict(ACTIVE_GATEWAYS):
-        DEFAULT_GATEWAY = ACTIVE_GATEWAYS[0][0]
-else:
-    DEFAULT_GATEWAY = ''
+    def __len__(self):
+        return len(_lazy_module.ACTIVE_GATEWAYS)
+
+    def __getitem__(self, index):
+        return _lazy_module.ACTIVE_GATEWAYS[index]
 
 def gateway(name):
     """ return gateway settings """
+    setup()
     return working_settings.get(name, {})
+
+class LazySettings(types.ModuleType):
+    """ Stands for this module in sys.modules: RESOLVED names are computed
+        by setup() on first access, everything else is passed through """
+    def __init__(self, module):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__['_module'] = module # keeps module globals alive
+
+    def __getattr__(self, name):
+        if name in RESOLVED:
+            self._module.setup()
+        return getattr(self._module, name)
+
+    def __setattr__(self, name, value):
+        if name in RESOLVED:
+            self._module.setup() # or it would overwrite the value later
+        setattr(self._module, name, value)
+
+_lazy_module = sys.modules[__name__] = LazySettings(sys.modules[__name__])
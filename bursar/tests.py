@@ -1,12 +1,17 @@
 # -*- coding: UTF-8 -*-
-import random
+import os, re, json, random, datetime
+import shutil
+import tempfile
+from decimal import Decimal
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.conf import settings
+from django.core.cache import cache
 
 from django import forms
 
 from bursar import settings as bursar_settings
-from bursar import utils, fields
+from bursar import utils, fields, models, bins, cardbundle, views
 from bursar.gateway import base
 
 def make_test_purchase(price):
@@ -38,6 +43,18 @@ class TestBase(TestCase):
 
     def test_settings(self):
         self.assertTrue(bursar_settings.ACTIVE_GATEWAYS)
+        self.assertEqual(list(models.Payment._meta.get_field('method').choices), bursar_settings.ACTIVE_GATEWAYS)
+
+        apps = [app for name, app in bursar_settings.ACTIVE_GATEWAYS]
+        self.assertEqual(bursar_settings.find_gateways({'GATEWAYS': apps}), bursar_settings.ACTIVE_GATEWAYS)
+
+        manifest = os.path.join(tempfile.mkdtemp(), 'gateways.json')
+        try:
+            self.assertEqual(bursar_settings.find_gateways({'GATEWAY_MANIFEST': manifest}), bursar_settings.ACTIVE_GATEWAYS)
+            self.assertEqual(bursar_settings.load_manifest(manifest, settings.INSTALLED_APPS), bursar_settings.ACTIVE_GATEWAYS)
+            self.assertIsNone(bursar_settings.load_manifest(manifest, list(settings.INSTALLED_APPS) + ['newapp']))
+        finally:
+            shutil.rmtree(os.path.dirname(manifest))
 
     def test_utils(self):
         self.assertTrue(utils.card_types)
@@ -55,9 +72,35 @@ class TestBase(TestCase):
         self.assertEqual('UNIONPAY', utils.get_cardtype('6222000200116010778'))
 
         gateway = bursar_settings.ACTIVE_GATEWAYS[0][0]
-        self.assertIsInstance(utils.get_processor(gateway)(None), base.BasePaymentProcessor)
+        self.assertIsInstance(utils.get_processor(gateway)(), base.BasePaymentProcessor)
+        self.assertIs(utils.get_processor_instance(gateway), utils.get_processor_instance(gateway))
         self.assertIsInstance(utils.get_form(gateway)(), forms.Form)
 
+    def test_cardtype_trie(self):
+        """ prefix trie gives the same answer as sequential regexp scan """
+        def get_cardtype_re(card_no):
+            for type, (lens, pattern) in utils.card_types:
+                if len(card_no) in lens and re.match(pattern, card_no):
+                    return type
+
+        prefixes = ['%04d' % i for i in range(10000)]
+        for type, (lens, pattern) in utils.card_types:
+            prefixes.extend(utils._expand_pattern(pattern)[0])
+
+        for length in range(11, 21):
+            for prefix in prefixes:
+                card_no = (prefix + '0123456789' * 2)[:length]
+                self.assertEqual(get_cardtype_re(card_no), utils.get_cardtype(card_no), card_no)
+
+    def test_validate_cards(self):
+        numbers = ['4444333322221111', '4917300800000000', '343434343434343', '6304900017740292441',
+                   '4444333322221112', '4444-3333-2222-1111', '42', '']
+        passes_mod10, lengths, card_types = utils.validate_cards(numbers)
+        for i, card_no in enumerate(numbers):
+            self.assertEqual(bool(passes_mod10[i]), card_no.isdigit() and utils.is_mod10(card_no), card_no)
+            self.assertEqual(lengths[i], len(card_no))
+            self.assertEqual(card_types[i], utils.get_cardtype(card_no), card_no)
+
     def test_fields(self):
         #Incorrect code length - VISA
         self.assertIsNotNone(fields.check_CVC('4444333322221111', ''))
@@ -85,4 +128,176 @@ class TestBase(TestCase):
         cc_field = fields.CreditCardField()
         self.assertRaises(forms.ValidationError, cc_field.validate, '42') #too short value
 
+    def test_card_bundle(self):
+        data = cardbundle.build()
+        self.assertEqual([card_type for card_type, lengths, prefixes in data['types']],
+                         [card_type for card_type, (lengths, pattern) in utils.card_types])
+        self.assertEqual(cardbundle.version(), data['version'])
+
+        directory = tempfile.mkdtemp()
+        try:
+            script, manifest = cardbundle.write(directory)
+            self.assertTrue(script.endswith(os.path.basename(cardbundle.script_name())))
+            with open(manifest) as manifest_file:
+                self.assertEqual(json.load(manifest_file), json.loads(json.dumps(data)))
+        finally:
+            shutil.rmtree(directory)
+
+        field = fields.CreditCardField(accept_cards=['VISA', 'AMEX'], widget=fields.CardNumberInput())
+        html = field.widget.render('card_no', '')
+        self.assertIn('data-accept="AMEX,VISA"', html)
+        self.assertIn('<span class="card VISA" data-card-type="VISA"></span>', html)
+        self.assertIn(cardbundle.script_name(), unicode(field.widget.media))
+
+    def test_ledger(self):
+        purchase = make_test_purchase(10)
+        gateway = bursar_settings.ACTIVE_GATEWAYS[0][0]
+        for amount, status in ((3, 'A'), (2, 'CD'), (1, 'S'), (4, 'R')):
+            models.Payment.objects.create(purchase=purchase, method=gateway, amount=amount, status=status)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(purchase.authorized_amount, 3)
+            self.assertEqual(purchase.captured_amount, 3)
+
+        purchase.authorizations[0]._update({'status': 'C'}) # resets the snapshot
+        self.assertEqual(purchase.authorized_amount, 0)
+        self.assertEqual(purchase.captured_amount, 3)
+
+    def test_status_moves(self):
+        for statuses in (('', 'A', 'CD', 'C'), ('A', 'CD', 'RF', 'CB', 'S', 'RF'), ('', 'S', 'CB', 'S'), ('A', 'RF')):
+            payment = models.Payment(status=statuses[0])
+            for status in statuses[1:]:
+                self.assertEqual(len(payment._apply({'status': status})), 1)
+                self.assertEqual(payment.status, status)
+        for old, new in (('C', 'A'), ('R', 'A'), ('RF', 'A'), ('EX', 'CD'), ('CB', ''),
+                         ('S', 'CD'), ('RF', 'CD'), ('S', 'C'), ('RF', 'S'), ('CB', 'CD')):
+            self.assertRaises(ValueError, models.Payment(status=old)._apply, {'status': new})
+
+    def test_payment_totals(self):
+        purchase = make_test_purchase(10)
+        gateway = bursar_settings.ACTIVE_GATEWAYS[0][0]
+        for amount, status in ((3, 'A'), (2, 'CD'), (1, 'S'), (4, 'RF')):
+            models.Payment.objects.create(purchase=purchase, method=gateway, amount=amount, status=status)
+
+        purchases = list(purchase.__class__.objects.with_payment_totals().filter(pk=purchase.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(purchases[0].authorized_amount, 3)
+            self.assertEqual(purchases[0].captured_amount, 3)
+
+        # refunds lower captured total, whether read from annotations or ledger
+        purchase = make_test_purchase(10)
+        models.Payment.objects.create(purchase=purchase, method='autosuccess', amount=6, status='CD')
+        models.Payment.objects.create(purchase=purchase, method='autosuccess', amount=4, status='S')
+        purchase.refund(7)
+        annotated = purchase.__class__.objects.with_payment_totals().get(pk=purchase.pk)
+        self.assertEqual((annotated.captured_amount, purchase.captured_amount), (3, 3))
+        purchase.refund(3)
+        annotated = purchase.__class__.objects.with_payment_totals().get(pk=purchase.pk)
+        self.assertEqual((annotated.captured_amount, purchase.captured_amount), (0, 0))
+        self.assertEqual(sorted(purchase.payments.values_list('status', flat=True)), ['RF', 'RF'])
+
+    def test_money(self):
+        self.assertEqual(utils.money(10.1), Decimal('10.10'))
+        self.assertEqual(utils.to_minor_units(Decimal('0.29')), 29)
+        self.assertEqual(utils.to_minor_units(0.29), 29) # int(0.29*100) is 28
+        self.assertEqual(utils.from_minor_units('1050'), Decimal('10.50'))
+        self.assertEqual(utils.from_minor_units(105, 0), Decimal('105'))
+
+        purchase = make_test_purchase(1)
+        gateway = bursar_settings.ACTIVE_GATEWAYS[0][0]
+        for i in range(10):
+            models.Payment.objects.create(purchase=purchase, method=gateway, amount=0.1, status='CD')
+        self.assertEqual(models.Payment.objects.filter(purchase=purchase)[0].amount, Decimal('0.10'))
+        self.assertEqual(purchase.captured_amount, Decimal('1.00')) # sum of floats is 0.9999..
+        purchases = purchase.__class__.objects.with_payment_totals().filter(pk=purchase.pk)
+        self.assertEqual(purchases[0].captured_amount, Decimal('1.00'))
+
+    def test_bins(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bins')
+            self.assertEqual(bins.compile_csv(['start,end,issuer,country,funding,card_type',
+                                               '4,4,,,,VISA',
+                                               '457173,457173,Danske Bank,DK,debit,VISA',
+                                               '51,55,,,credit,MASTERCARD'], path), 4)
+            database = bins.BinDatabase(path, check_interval=0)
+            self.assertEqual(database.lookup('4571730000000000'),
+                             {'issuer': 'Danske Bank', 'country': 'DK', 'funding': 'debit', 'card_type': 'VISA'})
+            self.assertEqual(database.lookup('4571740000000000')['issuer'], None) # outer range
+            self.assertEqual(database.lookup('5555555555554444')['funding'], 'credit')
+            self.assertIsNone(database.lookup('343434343434343'))
+            self.assertRaises(ValueError, bins.compile_csv, ['start,end', '55,51'], path)
+
+            bins.compile_csv(['start,end,issuer,country,funding,card_type', '34,37,,US,credit,AMEX'], path)
+            self.assertEqual(database.lookup('343434343434343')['card_type'], 'AMEX') # picked up without reopening
+            self.assertIsNone(database.lookup('4571730000000000'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_card_secrets(self):
+        purchase = make_test_purchase(10)
+        gateway = bursar_settings.ACTIVE_GATEWAYS[0][0]
+        saved_store = bursar_settings.STORE_CREDIT_NUMBERS
+        try:
+            for store, card_no in ((True, '4111111111111111'), (False, '5555555555554444')):
+                bursar_settings.STORE_CREDIT_NUMBERS = store
+                payment = models.Payment.objects.create(purchase=purchase, method=gateway, amount=1)
+                models.CreditCardDetail(payment=payment, card_no=card_no, ccv='123', name='John',
+                                        expiry=datetime.date(2030, 1, 1)).save()
+        finally:
+            bursar_settings.STORE_CREDIT_NUMBERS = saved_store
+
+        cards = list(models.CreditCardDetail.objects.filter(payment__purchase=purchase).order_by('id'))
+        self.assertEqual(models.decrypt_many([cards[0].encrypted_cc]), ['4111111111111111'])
+        models.CreditCardDetail.objects.decrypt_many(cards)
+        with self.assertNumQueries(0):
+            self.assertEqual([card.card_no for card in cards], ['4111111111111111', '5555555555554444'])
+            self.assertEqual([card.ccv for card in cards], ['123', '123'])
+        # single card path gives the same
+        card = models.CreditCardDetail.objects.get(pk=cards[1].pk)
+        self.assertEqual((card.card_no, card.ccv), ('5555555555554444', '123'))
+
+        # secrets cached under keys of previous versions are found and moved
+        cache.delete_many([card._key(), card._key('ccv')])
+        cache.set(card._legacy_key(), models._encrypt_code('5555555555554444'))
+        cache.set(card._legacy_key('ccv'), '123')
+        card = models.CreditCardDetail.objects.get(pk=cards[1].pk)
+        self.assertEqual((card.card_no, card.ccv), ('5555555555554444', '123'))
+        self.assertEqual(cache.get(card._key('ccv')), '123')
+        self.assertEqual(cache.get(card._legacy_key('ccv')), None)
+
+    def test_benchmarks(self):
+        from bursar import benchmarks
+        results = benchmarks.run([benchmarks.bench_get_cardtype, benchmarks.bench_crypto], scale=0.001)
+        self.assertIn('get_cardtype', results)
+        baseline = dict(results, get_cardtype=results['get_cardtype'] / 2)
+        self.assertEqual([name for name, baseline_usec, usec in benchmarks.compare(results, baseline)], ['get_cardtype'])
+
+    def test_metrics(self):
+        from bursar import metrics
+        from bursar.gateway.autosuccess import processor
+        recorded = []
+        saved_sinks = metrics.sinks, metrics.registry
+        metrics.configure({'prometheus': {}, 'callback': {'function': lambda *args: recorded.append(args)}})
+        try:
+            gateway = processor.PaymentProcessor()
+            gateway.capture_authorized(models.Payment(method='autosuccess', amount=10, status='A'), 5)
+            self.assertRaises(AssertionError, gateway.refund, models.Payment(method='autosuccess', amount=1), 2)
+
+            request = RequestFactory().get('/metrics', REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(views.metrics_view(request).status_code, 403)
+            class staff:
+                is_staff = True
+            request.user = staff
+            self.assertEqual(views.metrics_view(request).status_code, 200)
+        finally:
+            registry = metrics.registry
+            metrics.sinks, metrics.registry = saved_sinks
 
+        self.assertEqual([(gateway, operation, status, [phase for phase, seconds in phases])
+                          for gateway, operation, status, phases in recorded],
+                         [('AUTOSUCCESS', 'capture_authorized', 'CD', ['total']),
+                          ('AUTOSUCCESS', 'refund', 'error', ['total'])])
+        text = registry.render()
+        self.assertIn('bursar_gateway_operations_total{gateway="AUTOSUCCESS",operation="capture_authorized",status="CD"} 1', text)
+        self.assertIn('bursar_gateway_seconds_count{gateway="AUTOSUCCESS",operation="refund",phase="total",status="error"} 1', text)
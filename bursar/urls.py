@@ -5,15 +5,36 @@ from django.conf.urls.defaults import *
 from . import settings as bursar_settings
 from django.utils.importlib import import_module
 
+class LazyURLConf(object):
+    """ gateway urls module, imported when an url under it is first resolved or reversed """
+    def __init__(self, name):
+        self.name = name
+        self._urlpatterns = None
+
+    @property
+    def urlpatterns(self):
+        if self._urlpatterns is None:
+            try:
+                self._urlpatterns = import_module(self.name).urlpatterns
+            except ImportError: # gateway without urls
+                self._urlpatterns = []
+        return self._urlpatterns
+
+class GatewaysURLConf(object):
+    """ urls of ACTIVE_GATEWAYS under their names, listed when first resolved or
+        reversed: importing this module doesn't resolve bursar settings """
+    _urlpatterns = None
+
+    @property
+    def urlpatterns(self):
+        if self._urlpatterns is None:
+            # (urlconf, app_name, namespace) as include() returns it: include() itself would import the module
+            self._urlpatterns = patterns('', *[('^%s/'%gateway, (LazyURLConf(module+'.urls'), None, None))
+                                               for gateway, module in bursar_settings.ACTIVE_GATEWAYS])
+        return self._urlpatterns
+
 urlpatterns = patterns('',
     (r'^cardtype$',                         views.get_card_type),
+    (r'^metrics$',                          views.metrics_view),
+    (r'^',                                  (GatewaysURLConf(), None, None)),
 )
-
-for gateway, module in bursar_settings.ACTIVE_GATEWAYS:
-    try:
-        gateway_urls = import_module(module+'.urls')
-    except ImportError:
-        continue
-    urlpatterns += patterns('',
-            ('^%s/'%gateway,    include(gateway_urls)),
-        )
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-import sys, re
+import sys
+import decimal
+import threading
 
 from django.conf import settings
 from django import forms
@@ -7,6 +9,11 @@ from django.utils import importlib
 
 from bursar import settings as bursar_settings
 
+try:
+    import numpy
+except ImportError: # validate_cards() falls back to pure python
+    numpy = None
+
 card_types = (
     # ('<type>', (<tuple of possible num length>, 'regexp to match beginning')),
     ('VISA ELECTRON' , ((16,), '4(026|17500|508|844|913|917)')),
@@ -22,14 +29,74 @@ card_types = (
     ('DC'            , ((14,), '(30[0-5]|36|38)')),         #new diners club are 16 digits long and served by MC
 )
 
+def _expand_class(spec):
+    """ '126-925' => ['1', '2', '5', '6', '7', '8', '9'] """
+    chars, i = set(), 0
+    while i < len(spec):
+        if spec[i+1:i+2] == '-' and i+2 < len(spec):
+            chars.update(chr(c) for c in range(ord(spec[i]), ord(spec[i+2])+1))
+            i += 3
+        else:
+            chars.add(spec[i])
+            i += 1
+    return sorted(chars)
+
+def _expand_pattern(pattern, pos=0):
+    """ Expands card_types regexp (digits, [classes] and (alternatives) only)
+        into list of literal prefixes it matches.
+        Returns (prefixes, position where sequence ended) """
+    prefixes = ['']
+    while pos < len(pattern) and pattern[pos] not in '|)':
+        if pattern[pos] == '(':
+            options = []
+            while pattern[pos] != ')':
+                branch, pos = _expand_pattern(pattern, pos+1)
+                options.extend(branch)
+            pos += 1
+        elif pattern[pos] == '[':
+            end = pattern.index(']', pos)
+            options = _expand_class(pattern[pos+1:end])
+            pos = end + 1
+        else:
+            options = [pattern[pos]]
+            pos += 1
+        prefixes = [prefix + option for prefix in prefixes for option in options]
+    return prefixes, pos
+
+def _build_card_trie(card_types):
+    """ {card number length: digit prefix trie}. Trie nodes are dicts of
+        digit => child node, None => (card_types index, card type) """
+    tries = {}
+    for index, (type, (lens, pattern)) in enumerate(card_types):
+        for prefix in _expand_pattern(pattern)[0]:
+            for length in lens:
+                node = tries.setdefault(length, {})
+                for digit in prefix:
+                    node = node.setdefault(digit, {})
+                if None not in node: # keep the first match
+                    node[None] = (index, type)
+    return tries
+
+_card_trie = _build_card_trie(card_types)
+
+# [(card type, lengths, literal prefix), ..] in card_types order, for validate_cards()
+_card_prefixes = [(type, lens, prefix) for type, (lens, pattern) in card_types
+                                       for prefix in _expand_pattern(pattern)[0]]
+
 def get_cardtype(card_num):
     """ Identifies the credit card type """
     card_no = str(card_num)
-    card_len= len(card_no)
+    node = _card_trie.get(len(card_no))
+    match = None
+    for digit in card_no:
+        node = node and node.get(digit)
+        if not node:
+            break
+        terminal = node.get(None)
+        if terminal is not None and (match is None or terminal < match):
+            match = terminal # first entry of card_types wins, as in sequential scan
 
-    for type, (lens, pattern) in card_types:
-        if card_len in lens and re.match(pattern, card_no):
-            return type
+    return match and match[1]
 
 def is_mod10(cc):
     """ Check if credit card number passes mod10 validation """
@@ -38,12 +105,99 @@ def is_mod10(cc):
         total += d if i % 2 == 0 else (2*d if d <= 4 else 2*d - 9)
     return (total % 10) == 0
 
+def validate_cards(numbers):
+    """ Batch version of is_mod10() and get_cardtype() for bulk imports etc.
+        Returns aligned sequences (passes_mod10, lengths, card_types):
+        numpy arrays if numpy is installed, lists otherwise.
+        Numbers containing anything but digits never pass mod10 check """
+    numbers = [str(number) for number in numbers]
+    if numpy is None or not numbers:
+        return (
+            [number.isdigit() and is_mod10(number) for number in numbers],
+            [len(number) for number in numbers],
+            [get_cardtype(number) for number in numbers],
+        )
+
+    chars = numpy.array(numbers)
+    lengths = numpy.char.str_len(chars)
+    width = chars.itemsize
+    # digit matrix, left aligned and zero padded up to the longest number
+    digits = chars.view(numpy.uint8).reshape(len(numbers), width).astype(numpy.int16) - ord('0')
+    padding = numpy.arange(width) >= lengths[:, None]
+    is_digit = ((digits >= 0) & (digits <= 9)) | padding
+    digits[~is_digit | padding] = 0
+
+    # mod10: every second digit counting from the right one is doubled
+    doubled = (lengths[:, None] - numpy.arange(width)) % 2 == 0
+    luhn = numpy.where(doubled, digits * 2 - 9 * (digits > 4), digits)
+    passes_mod10 = (luhn.sum(axis=1) % 10 == 0) & is_digit.all(axis=1) & (lengths > 0)
+
+    # card types: compare leading digits with prefixes of card_types, first match wins
+    types = numpy.empty(len(numbers), dtype=object)
+    unknown = numpy.ones(len(numbers), dtype=bool)
+    prefix_len = max(len(prefix) for type, lens, prefix in _card_prefixes)
+    leading, leading_ok = [None], [None]
+    value, ok = numpy.zeros(len(numbers), dtype=numpy.int64), numpy.ones(len(numbers), dtype=bool)
+    for i in range(min(prefix_len, width)):
+        value = value * 10 + digits[:, i]
+        ok = ok & is_digit[:, i] & ~padding[:, i]
+        leading.append(value)
+        leading_ok.append(ok)
+
+    for type, lens, prefix in _card_prefixes:
+        if len(prefix) >= len(leading):
+            continue
+        match = unknown & leading_ok[len(prefix)] & (leading[len(prefix)] == int(prefix)) & numpy.in1d(lengths, lens)
+        types[match] = type
+        unknown &= ~match
+
+    return passes_mod10, lengths, types
+
+# amounts are Decimals with AMOUNT_PLACES decimal places, gateways exchange integer minor units
+AMOUNT_PLACES = 2
+_AMOUNT_QUANTUM = decimal.Decimal(1).scaleb(-AMOUNT_PLACES)
+
+def money(value):
+    """ amount as Decimal with AMOUNT_PLACES decimal places. Floats are taken by
+        their shortest repr, so money(10.1) is Decimal('10.10'), not 10.0999.. """
+    if value is None:
+        return None
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(repr(value) if isinstance(value, float) else value)
+    return value.quantize(_AMOUNT_QUANTUM, decimal.ROUND_HALF_UP)
+
+def to_minor_units(amount, exponent=AMOUNT_PLACES):
+    """ 10.5 => 1050 """
+    return int(money(amount).scaleb(exponent).to_integral_value(decimal.ROUND_HALF_UP))
+
+def from_minor_units(value, exponent=AMOUNT_PLACES):
+    """ 1050 or '1050' => Decimal('10.50'), no float arithmetic on the way """
+    return decimal.Decimal(int(value)).scaleb(-int(exponent))
+
+_processor_classes = {}
+_processors = {}
+_processors_lock = threading.Lock()
+
 def get_processor(gateway):
     """ Accepts module name eg 'worldpay' or bursar.gateway.worldpay
-        Returns PaymentProcessor instance """
-    appname = dict(bursar_settings.ACTIVE_GATEWAYS).get(gateway) or gateway
-    payment_processor_module = importlib.import_module(appname + ".processor") #might throw ImportError
-    return payment_processor_module.PaymentProcessor
+        Returns PaymentProcessor class """
+    processor_class = _processor_classes.get(gateway)
+    if processor_class is None:
+        appname = dict(bursar_settings.ACTIVE_GATEWAYS).get(gateway) or gateway
+        payment_processor_module = importlib.import_module(appname + ".processor") #might throw ImportError
+        processor_class = _processor_classes[gateway] = payment_processor_module.PaymentProcessor
+    return processor_class
+
+def get_processor_instance(gateway):
+    """ Same as get_processor, but returns PaymentProcessor instance shared
+        by all payments of the gateway. Settings are validated on first call """
+    processor = _processors.get(gateway)
+    if processor is None:
+        with _processors_lock:
+            processor = _processors.get(gateway)
+            if processor is None:
+                processor = _processors[gateway] = get_processor(gateway)()
+    return processor
 
 def get_form(gateway):
     """ Accepts module name eg 'worldpay' or bursar.gateway.worldpay
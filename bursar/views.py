@@ -2,10 +2,11 @@
 import re
 from django.conf import settings
 
-from django import forms
+from django import forms, http
 from django.utils.translation import ugettext as _
 
-import utils
+import utils, metrics, bins
+from bursar import settings as bursar_settings
 
 from common_utils.decorators import JSONP
 
@@ -18,9 +19,24 @@ def get_card_type(request):
     if not utils.is_mod10(card_no):
         return {'error' : _('Invalid card number')}
 
-    card_type = utils.get_cardtype(card_no)
+    card_bin = bins.lookup(card_no) # issuer details, if BIN_DATABASE is configured
+    card_type = card_bin and card_bin['card_type'] or utils.get_cardtype(card_no)
 
     if card_type is None:
         return {'error' : _('Invalid card number')}
 
+    if card_bin:
+        return dict(card_bin, card_type=card_type)
     return {'card_type': card_type}
+
+def metrics_view(request):
+    """ gateway operation histograms in Prometheus text format, if 'prometheus' metrics sink is configured.
+        Served to staff users and METRICS_ADDRESSES only """
+    user = getattr(request, 'user', None)
+    if not (user is not None and user.is_staff or
+            request.META.get('REMOTE_ADDR') in bursar_settings.working_settings.get('METRICS_ADDRESSES', ())):
+        return http.HttpResponseForbidden()
+    registry = metrics.get_registry()
+    if registry is None:
+        raise http.Http404
+    return http.HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')